@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# benchmark - part of iphoneMatic
+#
+# Times the stages of iphoneMatic on synthetic backups of several sizes (see fakeBackup.py) and
+# writes the results as JSON, with the commit they were measured on, so two commits can be compared:
+#
+#     python3 benchmark.py --output before.json
+#     git checkout my-branch
+#     python3 benchmark.py --output after.json --compare before.json
+#
+# License:   <a href="http://www.boost.org/LICENSE_1_0.txt">Boost License 1.0</a>.
+# Source:    benchmark.py
+#
+#          Copyright Juan Manuel Cabo 2026.
+# Distributed under the Boost Software License, Version 1.0.
+#    (See accompanying file LICENSE_1_0.txt or copy at
+#          http://www.boost.org/LICENSE_1_0.txt)
+#
+
+import os
+import sys
+import shutil
+import argparse
+import json
+import platform
+import subprocess
+import time
+from datetime import datetime
+from argparse import RawTextHelpFormatter
+from fakeBackup import generateBackup
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SIZES = [10000, 100000, 1000000]
+FAKE_BACKUP_VERSION = 2    #Backups of older versions of fakeBackup.py are created again
+#Each size is run like this; "again" runs over the result of "full", so only the journal is checked:
+RUNS = [("full", ["--full"]), ("again", []), ("pretend", ["--pretend", "--full"])]
+
+
+def gitDescribe():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=HERE,
+                               capture_output=True, text=True).stdout.strip() != ""
+        return commit + ("-dirty" if dirty else "")
+    except OSError:
+        return None
+
+def prepareBackup(workDir, files, seed, fileSize):
+    #The backups are kept between benchmarks, they are only created again if the parameters change:
+    backupDir = os.path.join(workDir, "backup_{}".format(files))
+    stampFilename = os.path.join(backupDir, "fakeBackup.json")
+    params = {"files": files, "seed": seed, "fileSize": fileSize, "generator": FAKE_BACKUP_VERSION}
+    if os.path.isfile(stampFilename):
+        with open(stampFilename, 'r', encoding='utf-8') as file:
+            if json.load(file) == params:
+                return backupDir
+    print("Creating backup of {} files...".format(files))
+    start = time.time()
+    generateBackup(backupDir, files, seed=seed, fileSize=fileSize)
+    print("    done in {:.1f}s".format(time.time() - start))
+    with open(stampFilename, 'w', encoding='utf-8') as file:
+        json.dump(params, file)
+    return backupDir
+
+def runIphoneMatic(backupDir, outDir, options, extraArgs):
+    #Returns the summary written by --summary-json, plus the wall time of the whole process.
+    summaryFilename = outDir + ".summary.json"
+    command = [sys.executable, os.path.join(HERE, "iphoneMatic.py"), "-q", "--summary-json", summaryFilename] \
+              + options + extraArgs + [backupDir, outDir]
+    start = time.time()
+    result = subprocess.run(command, cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    wallSeconds = time.time() - start
+    if result.returncode != 0 or not os.path.isfile(summaryFilename):
+        raise Exception("iphoneMatic failed: " + " ".join(command) + "\n" + result.stderr)
+    with open(summaryFilename, 'r', encoding='utf-8') as file:
+        summary = json.load(file)
+    os.remove(summaryFilename)
+    return {"wallSeconds": round(wallSeconds, 3),
+            "phases": {p["name"]: {"seconds": p["seconds"], "done": p["done"], "filesPerSecond": p["filesPerSecond"],
+                                   "peakRssMB": p["peakRssMB"]} for p in summary["phases"]},
+            "databases": summary.get("databases")}
+
+def verifyExtraction(backupDir, outDir):
+    #A fresh extraction of a fake backup must pass verify: the sizes in Manifest.db, in the databases
+    #of the backup and of the extracted files have to agree, or the timings are of a broken run.
+    command = [sys.executable, os.path.join(HERE, "iphoneMatic.py"), "verify", backupDir, outDir]
+    result = subprocess.run(command, cwd=HERE, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise Exception("verify failed after extracting " + backupDir + ":\n" + result.stdout + result.stderr)
+
+def bestOf(results):
+    #The fastest repetition of every phase, the others are usually noise (disk cache, other processes):
+    best = dict(results[0])
+    best["wallSeconds"] = min(r["wallSeconds"] for r in results)
+    best["phases"] = {}
+    for name in results[0]["phases"]:
+        best["phases"][name] = min((r["phases"][name] for r in results if name in r["phases"]), key=lambda p: p["seconds"])
+    return best
+
+def benchmark(workDir, sizes, repeat, seed, fileSize, extraArgs):
+    results = {"iphoneMaticBenchmark": 1, "commit": gitDescribe(), "date": datetime.now().isoformat(),
+               "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+               "args": extraArgs, "sizes": {}}
+    for files in sizes:
+        backupDir = prepareBackup(workDir, files, seed, fileSize)
+        outDir = os.path.join(workDir, "out_{}".format(files))
+        runs = {}
+        for runName, options in RUNS:
+            repetitions = []
+            for i in range(repeat):
+                if runName != "again" and os.path.exists(outDir):
+                    shutil.rmtree(outDir)
+                repetitions.append(runIphoneMatic(backupDir, outDir, options, extraArgs))
+                print("{} files, {} run {}: {:.2f}s".format(files, runName, i + 1, repetitions[-1]["wallSeconds"]))
+                if runName == "full" and i == 0 and "--archive" not in extraArgs:
+                    verifyExtraction(backupDir, outDir)
+            runs[runName] = bestOf(repetitions)
+        shutil.rmtree(outDir, ignore_errors=True)
+        results["sizes"][str(files)] = runs
+    return results
+
+def printComparison(old, new):
+    print("\nPhase seconds: {} -> {}".format(old.get("commit"), new.get("commit")))
+    for size, runs in new["sizes"].items():
+        if size not in old["sizes"]:
+            continue
+        for runName, run in runs.items():
+            oldRun = old["sizes"][size].get(runName)
+            if oldRun == None:
+                continue
+            print("\n{} files, {}:".format(size, runName))
+            rows = [("(total)", oldRun["wallSeconds"], run["wallSeconds"])]
+            for name, phase in run["phases"].items():
+                if name in oldRun["phases"]:
+                    rows.append((name, oldRun["phases"][name]["seconds"], phase["seconds"]))
+            for name, before, after in rows:
+                change = "{:+.0f}%".format((after - before) * 100 / before) if before > 0 else ""
+                print("    {:<26} {:9.2f} {:9.2f}  {}".format(name, before, after, change))
+
+
+def main():
+    desc = "Times iphoneMatic on synthetic backups and writes the results as JSON\n" \
+           + "\nExample:  python3 benchmark.py --sizes 10000,100000 --output results.json --compare before.json" \
+           + "\n\nOptions after -- are passed to iphoneMatic, eg:  python3 benchmark.py -- --jobs 4"
+    parser = argparse.ArgumentParser(description=desc, formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--sizes', default=",".join(str(size) for size in DEFAULT_SIZES),
+                        help="Comma separated number of files of the backups (default: 10000,100000,1000000)")
+    parser.add_argument('--work-dir', default=os.path.join(HERE, "benchmark_data"),
+                        help="Where the backups are created and kept between runs (default: ./benchmark_data)")
+    parser.add_argument('--repeat', type=int, default=1, help="Runs of each benchmark, the fastest one is kept (default: 1)")
+    parser.add_argument('--seed', type=int, default=1, help="Seed of the backups (default: 1)")
+    parser.add_argument('--file-size', type=int, default=4096, help="Average size in bytes of the files (default: 4096)")
+    parser.add_argument('--output', metavar='FILE', help="Where to write the results (default: benchmark_COMMIT.json)")
+    parser.add_argument('--compare', metavar='FILE', help="Results of a previous benchmark, to print the differences")
+    parser.add_argument('iphonematic_args', nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    extraArgs = args.iphonematic_args
+    if len(extraArgs) > 0 and extraArgs[0] == "--":
+        extraArgs = extraArgs[1:]
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip() != ""]
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    results = benchmark(args.work_dir, sizes, max(1, args.repeat), args.seed, args.file_size, extraArgs)
+    output = args.output if args.output != None else "benchmark_{}.json".format(results["commit"] or "results")
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump(results, file, indent=4)
+    print("Results written to " + output)
+
+    if args.compare != None:
+        with open(args.compare, 'r', encoding='utf-8') as file:
+            printComparison(json.load(file), results)
+
+
+#Run program:
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+# fakeBackup - part of iphoneMatic
+#
+# Creates a synthetic iPhone backup, with the layout that iphoneMatic reads: Manifest.db with
+# NSKeyedArchiver MBFile blobs, the shard directories, Photos.sqlite with albums, ChatStorage.sqlite,
+# ContactsV2.sqlite, AddressBook.sqlitedb and NoteStore.sqlite. Everything is scaled by the
+# parameters and is the same for the same --seed, so real backups (which can't be shared) aren't
+# needed to measure a change. See benchmark.py.
+#
+# License:   <a href="http://www.boost.org/LICENSE_1_0.txt">Boost License 1.0</a>.
+# Source:    fakeBackup.py
+#
+#          Copyright Juan Manuel Cabo 2026.
+# Distributed under the Boost Software License, Version 1.0.
+#    (See accompanying file LICENSE_1_0.txt or copy at
+#          http://www.boost.org/LICENSE_1_0.txt)
+#
+
+import os
+import shutil
+import sqlite3
+import argparse
+import hashlib
+import plistlib
+import random
+import zlib
+import time
+from argparse import RawTextHelpFormatter
+
+MAC_EPOCH = 978307200
+WHATSAPP_DOMAIN = "AppDomainGroup-group.net.whatsapp.WhatsApp.shared"
+APP_GROUP_DOMAINS = ["AppDomainGroup-group.com.skyjos.ftpmanager",
+                     "AppDomainGroup-group.com.apple.FileProvider.LocalStorage",
+                     "AppDomainGroup-group.com.apple.notes",
+                     "AppDomainGroup-group.com.example.photoeditor"]
+#Share of the files of each kind:
+CAMERA_SHARE = 0.55
+WHATSAPP_SHARE = 0.25
+THUMBNAIL_SHARE = 0.05       #CameraRollDomain files that aren't extracted
+CAMERA_EXTENSIONS = [".HEIC", ".HEIC", ".HEIC", ".JPG", ".PNG", ".MOV", ".MOV", ".MP4"]
+WHATSAPP_EXTENSIONS = [".jpg", ".jpg", ".jpg", ".mp4", ".opus", ".webp", ".thumb", ".pdf"]
+APP_EXTENSIONS = [".jpg", ".pdf", ".txt", ".plist", ".mov", ".docx", ".zip"]
+START_TIME = 1640995200      #2022-01-01, the files are spread over the following years
+SPAN_SECONDS = 4 * 365 * 86400
+
+
+def fileIdFor(domain, relativePath):
+    #Same as the backups made by iTunes/Apple Devices:
+    return hashlib.sha1((domain + "-" + relativePath).encode("utf-8")).hexdigest()
+
+def mbFileBlob(relativePath, lastModified, size, inode, originalFilename=None, isDir=False):
+    #NSKeyedArchiver MBFile, as in the Files.file column of Manifest.db. The extended attributes
+    #(a nested binary plist) go in $objects[3] when there are any, like in real backups.
+    mbFile = {"$class": None, "RelativePath": plistlib.UID(2), "LastModified": lastModified,
+              "LastStatusChange": lastModified, "Birth": lastModified, "Size": 0 if isDir else size,
+              "Mode": 0o40755 if isDir else 0o100644, "InodeNumber": inode, "UserID": 501, "GroupID": 501,
+              "ProtectionClass": 0 if isDir else 3, "Flags": 0}
+    objects = ["$null", mbFile, relativePath]
+    if originalFilename != None:
+        mbFile["ExtendedAttributes"] = plistlib.UID(3)
+        attributes = {"com.apple.assetsd.originalFilename": originalFilename.encode("utf-8"),
+                      "com.apple.assetsd.UUID": hashlib.md5(relativePath.encode("utf-8")).digest()}
+        objects.append(plistlib.dumps(attributes, fmt=plistlib.FMT_BINARY))
+    mbFile["$class"] = plistlib.UID(len(objects))
+    objects.append({"$classname": "MBFile", "$classes": ["MBFile", "NSObject"]})
+    return plistlib.dumps({"$version": 100000, "$archiver": "NSKeyedArchiver", "$top": {"root": plistlib.UID(1)},
+                           "$objects": objects}, fmt=plistlib.FMT_BINARY)
+
+def noteBody(text):
+    #Gzipped protobuf of a note with only its text, as in ZICNOTEDATA.ZDATA:
+    def field(number, payload):
+        return bytes([number << 3 | 2]) + varint(len(payload)) + payload
+    def varint(n):
+        out = b""
+        while n > 0x7F:
+            out += bytes([n & 0x7F | 0x80])
+            n >>= 7
+        return out + bytes([n])
+    note = field(2, text.encode("utf-8"))
+    document = b"\x08\x00\x10\x00" + field(3, note)
+    compressor = zlib.compressobj(wbits=31)
+    return compressor.compress(b"\x08\x00" + field(2, document)) + compressor.flush()
+
+
+class FakeBackup:
+    MANIFEST_BATCH = 10000
+
+    def __init__(self, backupDir, seed=1, fileSize=4096):
+        self.backupDir = backupDir
+        self.random = random.Random(seed)
+        self.fileSize = fileSize
+        self.data = self.random.randbytes(fileSize * 2) if fileSize > 0 else b""
+        self.rows = []
+        self.inode = 1000
+        self.shards = set()
+        self.counts = {}
+        self.manifest = None
+
+    def randomTime(self):
+        return START_TIME + self.random.randrange(SPAN_SECONDS)
+
+    def backupPath(self, fileId):
+        shard = fileId[:2]
+        if shard not in self.shards:
+            os.makedirs(os.path.join(self.backupDir, shard), exist_ok=True)
+            self.shards.add(shard)
+        return os.path.join(self.backupDir, shard, fileId)
+
+    def addRow(self, fileId, domain, relativePath, flags, blob):
+        self.rows.append((fileId, domain, relativePath, flags, blob))
+        if len(self.rows) >= self.MANIFEST_BATCH:
+            self.flushRows()
+
+    def flushRows(self):
+        self.manifest.executemany("INSERT INTO Files VALUES (?, ?, ?, ?, ?)", self.rows)
+        self.rows = []
+
+    def addFile(self, kind, domain, relativePath, lastModified=None, originalFilename=None, size=None):
+        #Writes the content to its shard and adds the row to Manifest.db. Returns the size written, which
+        #the databases that describe the file (Photos.sqlite, ChatStorage.sqlite) must agree with.
+        fileId = fileIdFor(domain, relativePath)
+        if lastModified == None:
+            lastModified = self.randomTime()
+        if size == None:
+            size = self.random.randint(self.fileSize // 2, self.fileSize * 3 // 2) if self.fileSize > 0 else 0
+        offset = self.random.randrange(len(self.data) - size + 1) if size > 0 else 0
+        path = self.backupPath(fileId)
+        with open(path, "wb") as file:
+            file.write(self.data[offset:offset + size])
+        self.inode += 1
+        self.addRow(fileId, domain, relativePath, 1, mbFileBlob(relativePath, lastModified, size, self.inode, originalFilename))
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        return size
+
+    def addDirectory(self, domain, relativePath):
+        self.inode += 1
+        self.addRow(fileIdFor(domain, relativePath), domain, relativePath, 2,
+                    mbFileBlob(relativePath, self.randomTime(), 0, self.inode, isDir=True))
+
+    def addDatabase(self, kind, domain, relativePath, fill):
+        #Creates an SQLite database in its shard with fill(conn) and adds it to Manifest.db.
+        fileId = fileIdFor(domain, relativePath)
+        path = self.backupPath(fileId)
+        conn = sqlite3.connect(path)
+        fill(conn)
+        conn.commit()
+        conn.close()
+        self.inode += 1
+        self.addRow(fileId, domain, relativePath, 1, mbFileBlob(relativePath, int(time.time()), os.path.getsize(path), self.inode))
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+
+    def generate(self, files, albums, chats, messages, contacts, notes):
+        if os.path.exists(self.backupDir):
+            shutil.rmtree(self.backupDir)
+        os.makedirs(self.backupDir)
+        self.manifest = sqlite3.connect(os.path.join(self.backupDir, "Manifest.db"))
+        self.manifest.execute("CREATE TABLE Files (fileID TEXT PRIMARY KEY, domain TEXT, relativePath TEXT, flags INTEGER, file BLOB)")
+        self.manifest.execute("CREATE INDEX FilesDomainIdx ON Files(domain)")
+        self.manifest.execute("CREATE INDEX FilesRelativePathIdx ON Files(relativePath)")
+        self.manifest.execute("CREATE TABLE Properties (key TEXT PRIMARY KEY, value BLOB)")
+
+        cameraFiles = int(files * CAMERA_SHARE)
+        whatsappFiles = int(files * WHATSAPP_SHARE)
+        thumbnailFiles = int(files * THUMBNAIL_SHARE)
+        appFiles = max(files - cameraFiles - whatsappFiles - thumbnailFiles, 0)
+
+        assets = self.generateCamera(cameraFiles, thumbnailFiles)
+        mediaItems = self.generateWhatsappMedia(whatsappFiles, chats)
+        self.generateAppFiles(appFiles)
+
+        self.addDatabase("Photos.sqlite", "CameraRollDomain", "Media/PhotoData/Photos.sqlite",
+                         lambda conn: self.fillPhotos(conn, assets, albums))
+        self.addDatabase("ChatStorage.sqlite", WHATSAPP_DOMAIN, "ChatStorage.sqlite",
+                         lambda conn: self.fillChatStorage(conn, mediaItems, chats, messages))
+        self.addDatabase("ContactsV2.sqlite", WHATSAPP_DOMAIN, "ContactsV2.sqlite",
+                         lambda conn: self.fillWhatsappContacts(conn, chats))
+        self.addDatabase("AddressBook.sqlitedb", "HomeDomain", "Library/AddressBook/AddressBook.sqlitedb",
+                         lambda conn: self.fillAddressBook(conn, contacts))
+        self.addDatabase("NoteStore.sqlite", "AppDomainGroup-group.com.apple.notes", "NoteStore.sqlite",
+                         lambda conn: self.fillNoteStore(conn, notes))
+
+        self.flushRows()
+        self.manifest.commit()
+        self.manifest.close()
+        return self.counts
+
+    def generateCamera(self, count, thumbnails):
+        #IMG_NNNN names in 100APPLE, 101APPLE... like the DCIM of the phone. Some pictures are
+        #taken in bursts (same second), some keep the original name of an imported file.
+        assets = []
+        burstTime = None
+        self.addDirectory("CameraRollDomain", "Media/DCIM")
+        for i in range(count):
+            directory = "DCIM/{}APPLE".format(100 + i // 1000)
+            if i % 1000 == 0:
+                self.addDirectory("CameraRollDomain", "Media/" + directory)
+            extension = self.random.choice(CAMERA_EXTENSIONS)
+            filename = "IMG_{:04d}{}".format(i % 10000, extension)
+            if burstTime != None and self.random.random() < 0.7:
+                lastModified = burstTime
+            else:
+                lastModified = self.randomTime()
+                burstTime = lastModified if self.random.random() < 0.05 else None
+            originalFilename = None
+            if self.random.random() < 0.1:
+                originalFilename = self.random.choice(["IMG_{:04d}.JPG".format(self.random.randrange(10000)),
+                                                       "Screenshot {}.png".format(i), "{:08X}-0000-4000-8000-000000000000.jpg".format(i)])
+            size = self.addFile("Camera", "CameraRollDomain", "Media/" + directory + "/" + filename, lastModified, originalFilename)
+            assets.append((directory, filename, lastModified, originalFilename, size))
+        for i in range(thumbnails):
+            self.addFile("Thumbnails", "CameraRollDomain", "Media/PhotoData/Thumbnails/V2/DCIM/100APPLE/IMG_{:04d}.JPG/5005.JPG".format(i))
+        return assets
+
+    def generateWhatsappMedia(self, count, chats):
+        #Media of the chats, plus a few profile pictures. Returns the ZWAMEDIAITEM rows.
+        mediaItems = []
+        profiles = min(count // 50, chats)
+        for i in range(profiles):
+            self.addFile("WhatsappProfilePictures", WHATSAPP_DOMAIN, "Media/Profile/{}-{}.jpg".format(5491100000000 + i, 1600000000 + i))
+        for i in range(count - profiles):
+            jid = "{}@s.whatsapp.net".format(5491100000000 + self.random.randrange(max(chats, 1)))
+            extension = self.random.choice(WHATSAPP_EXTENSIONS)
+            guid = "{:08x}-{:04x}-4{:03x}-8{:03x}-{:012x}".format(self.random.getrandbits(32), self.random.getrandbits(16),
+                   self.random.getrandbits(12), self.random.getrandbits(12), self.random.getrandbits(48))
+            mediaPath = "Media/{}/{}/{}/{}{}".format(jid, guid[0], guid[1], guid, extension)
+            size = self.addFile("Whatsapp", WHATSAPP_DOMAIN, "Message/" + mediaPath)
+            documentName = "Document {}.pdf".format(i) if extension == ".pdf" else None
+            mediaItems.append((len(mediaItems) + 1, mediaPath, documentName, extension, size))
+        return mediaItems
+
+    def generateAppFiles(self, count):
+        #Files of the Files app, FTPManager, other app groups and the home domain:
+        domains = APP_GROUP_DOMAINS + ["HomeDomain"]
+        for i in range(count):
+            domain = self.random.choice(domains)
+            extension = self.random.choice(APP_EXTENSIONS)
+            if domain == "HomeDomain":
+                relativePath = "Library/Preferences/com.example.app{}{}".format(i, extension)
+            elif domain.endswith("LocalStorage"):
+                relativePath = "File Provider Storage/Folder {}/file{}{}".format(i % 50, i, extension)
+            else:
+                relativePath = "Documents/dir{}/file{}{}".format(i % 100, i, extension)
+            self.addFile(domain, domain, relativePath)
+
+    def fillPhotos(self, conn, assets, albums):
+        conn.executescript("""
+            CREATE TABLE ZGENERICALBUM (Z_PK INTEGER PRIMARY KEY, ZKIND INTEGER, ZTITLE VARCHAR, ZPARENTFOLDER INTEGER);
+            CREATE TABLE ZASSET (Z_PK INTEGER PRIMARY KEY, ZDIRECTORY VARCHAR, ZFILENAME VARCHAR, ZDATECREATED TIMESTAMP,
+                                 ZMODIFICATIONDATE TIMESTAMP, ZKIND INTEGER);
+            CREATE TABLE ZADDITIONALASSETATTRIBUTES (Z_PK INTEGER PRIMARY KEY, ZASSET INTEGER, ZORIGINALFILENAME VARCHAR,
+                                                     ZORIGINALFILESIZE INTEGER);
+            CREATE TABLE Z_33ASSETS (Z_33ALBUMS INTEGER, Z_3ASSETS INTEGER, Z_FOK_3ASSETS INTEGER, PRIMARY KEY (Z_33ALBUMS, Z_3ASSETS));
+            CREATE INDEX Z_33ASSETS_Z_3ASSETS_INDEX ON Z_33ASSETS (Z_3ASSETS, Z_33ALBUMS);
+            CREATE INDEX ZADDITIONALASSETATTRIBUTES_ZASSET ON ZADDITIONALASSETATTRIBUTES (ZASSET);
+        """)
+        #1 is the root folder, 2 a folder inside it, the albums go in either:
+        conn.execute("INSERT INTO ZGENERICALBUM VALUES (1, 3999, NULL, NULL)")
+        conn.execute("INSERT INTO ZGENERICALBUM VALUES (2, 4000, 'Trips', 1)")
+        for i in range(albums):
+            conn.execute("INSERT INTO ZGENERICALBUM VALUES (?, 2, ?, ?)", (i + 3, "Album {}".format(i), 2 if i % 3 == 0 else 1))
+        rows = []
+        attributes = []
+        members = []
+        for pk, (directory, filename, lastModified, originalFilename, size) in enumerate(assets, 1):
+            #The capture time is usually a bit before the file was written:
+            created = lastModified - MAC_EPOCH - self.random.randrange(5)
+            rows.append((pk, directory, filename, created, lastModified - MAC_EPOCH, 1 if filename.endswith((".MOV", ".MP4")) else 0))
+            attributes.append((pk, pk, originalFilename or filename, size))
+            if albums > 0 and self.random.random() < 0.2:
+                for album in self.random.sample(range(albums), min(albums, self.random.choice([1, 1, 1, 2]))):
+                    members.append((album + 3, pk, pk))
+        conn.executemany("INSERT INTO ZASSET VALUES (?, ?, ?, ?, ?, ?)", rows)
+        conn.executemany("INSERT INTO ZADDITIONALASSETATTRIBUTES VALUES (?, ?, ?, ?)", attributes)
+        conn.executemany("INSERT INTO Z_33ASSETS VALUES (?, ?, ?)", members)
+
+    def fillChatStorage(self, conn, mediaItems, chats, messages):
+        conn.executescript("""
+            CREATE TABLE ZWAMEDIAITEM (Z_PK INTEGER PRIMARY KEY, ZFILESIZE INTEGER, ZMEDIALOCALPATH VARCHAR,
+                                       ZXMPPTHUMBPATH VARCHAR, ZAUTHORNAME VARCHAR);
+            CREATE TABLE ZWACHATSESSION (Z_PK INTEGER PRIMARY KEY, ZPARTNERNAME VARCHAR, ZLASTMESSAGEDATE TIMESTAMP,
+                                         ZCONTACTIDENTIFIER VARCHAR, ZCONTACTJID VARCHAR);
+            CREATE TABLE ZWAGROUPMEMBER (Z_PK INTEGER PRIMARY KEY, ZMEMBERJID VARCHAR);
+            CREATE TABLE ZWAMESSAGEDATAITEM (Z_PK INTEGER PRIMARY KEY, ZMESSAGE INTEGER, ZTHUMBNAILPATH VARCHAR, ZTITLE VARCHAR,
+                                             ZSUMMARY VARCHAR, ZCONTENT1 VARCHAR, ZCONTENT2 VARCHAR);
+            CREATE TABLE ZWAMESSAGE (Z_PK INTEGER PRIMARY KEY, ZTEXT VARCHAR, ZMESSAGEDATE TIMESTAMP, ZCHATSESSION INTEGER,
+                                     ZGROUPMEMBER INTEGER, ZMESSAGETYPE INTEGER, ZFROMJID VARCHAR, ZTOJID VARCHAR, ZMEDIAITEM INTEGER);
+            CREATE INDEX ZWAMESSAGE_ZFROMJID ON ZWAMESSAGE (ZFROMJID);
+            CREATE INDEX ZWAMESSAGE_ZTOJID ON ZWAMESSAGE (ZTOJID);
+            CREATE INDEX ZWAMESSAGEDATAITEM_ZMESSAGE ON ZWAMESSAGEDATAITEM (ZMESSAGE);
+        """)
+        typeByExtension = {".jpg": 1, ".mp4": 2, ".opus": 3, ".pdf": 8, ".webp": 15}
+        conn.executemany("INSERT INTO ZWAMEDIAITEM VALUES (?, ?, ?, NULL, ?)",
+                         [(pk, size, mediaPath, documentName) for pk, mediaPath, documentName, extension, size in mediaItems])
+        jids = ["{}@s.whatsapp.net".format(5491100000000 + i) for i in range(chats)]
+        lastDates = {}
+        rows = []
+        mediaByJid = {}
+        for pk, mediaPath, documentName, extension, size in mediaItems:
+            if extension in typeByExtension:
+                mediaByJid.setdefault(mediaPath.split("/")[1], []).append((pk, typeByExtension[extension]))
+        pk = 0
+        for chat, jid in enumerate(jids):
+            #A few chats have most of the messages:
+            count = messages // chats if chat % 10 else messages // chats * 3
+            media = mediaByJid.get(jid, [])
+            date = START_TIME - MAC_EPOCH + self.random.randrange(SPAN_SECONDS)
+            for i in range(count + len(media)):
+                pk += 1
+                date += self.random.randrange(1, 3600)
+                fromJid, toJid = (jid, None) if self.random.random() < 0.5 else (None, jid)
+                if i < len(media):
+                    rows.append((pk, None, date, chat + 1, None, media[i][1], fromJid, toJid, media[i][0]))
+                else:
+                    rows.append((pk, "Message {} of chat {}".format(i, chat), date, chat + 1, None, 0, fromJid, toJid, None))
+            lastDates[jid] = date
+        conn.executemany("INSERT INTO ZWAMESSAGE VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        conn.executemany("INSERT INTO ZWACHATSESSION VALUES (?, ?, ?, NULL, ?)",
+                         [(i + 1, "Contact {}".format(i % max(chats * 9 // 10, 1)), lastDates.get(jid), jid) for i, jid in enumerate(jids)])
+
+    def fillWhatsappContacts(self, conn, chats):
+        conn.execute("CREATE TABLE ZWAADDRESSBOOKCONTACT (Z_PK INTEGER PRIMARY KEY, ZFULLNAME VARCHAR, ZBUSINESSNAME VARCHAR, " \
+                     + "ZPHONENUMBER VARCHAR, ZLID VARCHAR, ZWHATSAPPID VARCHAR)")
+        conn.executemany("INSERT INTO ZWAADDRESSBOOKCONTACT VALUES (?, ?, NULL, ?, ?, ?)",
+                         [(i + 1, "Contact {}".format(i), "+{}".format(5491100000000 + i), "{}@lid".format(100000 + i),
+                           "{}@s.whatsapp.net".format(5491100000000 + i)) for i in range(chats)])
+
+    def fillAddressBook(self, conn, contacts):
+        conn.executescript("""
+            CREATE TABLE ABMultiValueLabel (value TEXT);
+            INSERT INTO ABMultiValueLabel VALUES ('_$!<Mobile>!$_'), ('_$!<Home>!$_'), ('_$!<Work>!$_');
+            CREATE TABLE ABPerson (ROWID INTEGER PRIMARY KEY, First TEXT, Middle TEXT, Last TEXT, Birthday TEXT);
+            CREATE TABLE ABMultiValue (UID INTEGER PRIMARY KEY, record_id INTEGER, property INTEGER, identifier INTEGER,
+                                       label INTEGER, value TEXT);
+            CREATE TABLE ABMultiValueEntry (parent_id INTEGER, key INTEGER, value TEXT);
+        """)
+        people = []
+        values = []
+        for i in range(contacts):
+            birthday = str(self.random.randrange(-900000000, 300000000)) if self.random.random() < 0.2 else None
+            people.append((i + 1, "First{}".format(i), None, "Last{}".format(i), birthday))
+            values.append((None, i + 1, 3, 0, self.random.randint(1, 3), "+54 9 11 {:04d}-{:04d}".format(i // 10000, i % 10000)))
+            if i % 3 == 0:
+                values.append((None, i + 1, 4, 0, 3, "person{}@example.com".format(i)))
+        conn.executemany("INSERT INTO ABPerson VALUES (?, ?, ?, ?, ?)", people)
+        conn.executemany("INSERT INTO ABMultiValue VALUES (?, ?, ?, ?, ?, ?)", values)
+
+    def fillNoteStore(self, conn, notes):
+        conn.executescript("""
+            CREATE TABLE ZICNOTEDATA (Z_PK INTEGER PRIMARY KEY, ZNOTE INTEGER, ZDATA BLOB);
+            CREATE TABLE ZICCLOUDSYNCINGOBJECT (Z_PK INTEGER PRIMARY KEY, ZNOTEDATA INTEGER, ZFOLDER INTEGER, ZNOTE INTEGER,
+                ZATTACHMENT1 INTEGER, ZMEDIA INTEGER, ZACCOUNT2 INTEGER, ZACCOUNT3 INTEGER, ZFILESIZE INTEGER, ZFILENAME VARCHAR,
+                ZIDENTIFIER VARCHAR, ZTITLE1 VARCHAR, ZTITLE2 VARCHAR, ZSNIPPET VARCHAR, ZNAME VARCHAR, ZACCOUNTTYPE INTEGER,
+                ZCREATIONDATE1 TIMESTAMP, ZLASTVIEWEDMODIFICATIONDATE TIMESTAMP, ZMODIFICATIONDATE1 TIMESTAMP);
+        """)
+        #1 is the account, 2 the folder, the notes follow:
+        conn.execute("INSERT INTO ZICCLOUDSYNCINGOBJECT (Z_PK, ZIDENTIFIER, ZNAME, ZACCOUNTTYPE) VALUES (1, 'LocalAccount', 'On My iPhone', 3)")
+        conn.execute("INSERT INTO ZICCLOUDSYNCINGOBJECT (Z_PK, ZIDENTIFIER, ZTITLE2, ZACCOUNT3) VALUES (2, 'DefaultFolder', 'Notes', 1)")
+        for i in range(notes):
+            pk = i + 3
+            text = "Note {}\n".format(i) + "Some text of the note.\n" * self.random.randint(1, 20)
+            created = self.randomTime() - MAC_EPOCH
+            conn.execute("INSERT INTO ZICNOTEDATA VALUES (?, ?, ?)", (i + 1, pk, noteBody(text)))
+            conn.execute("INSERT INTO ZICCLOUDSYNCINGOBJECT (Z_PK, ZNOTEDATA, ZFOLDER, ZACCOUNT2, ZIDENTIFIER, ZTITLE1, ZSNIPPET, " \
+                         + "ZCREATIONDATE1, ZLASTVIEWEDMODIFICATIONDATE, ZMODIFICATIONDATE1) VALUES (?, ?, 2, 1, ?, ?, ?, ?, ?, ?)",
+                         (pk, i + 1, "NOTE-{:08d}".format(i), "Note {}".format(i), "Some text of the note.",
+                          created, created + 60, created + self.random.randrange(86400 * 30)))
+
+
+def generateBackup(backupDir, files=10000, albums=None, chats=None, messages=None, contacts=None, notes=None, seed=1, fileSize=4096):
+    #The databases grow with the number of files unless they are given:
+    albums = albums if albums != None else max(files // 2000, 3)
+    chats = chats if chats != None else max(files // 500, 5)
+    messages = messages if messages != None else files * 2
+    contacts = contacts if contacts != None else max(files // 100, 10)
+    notes = notes if notes != None else max(files // 1000, 5)
+    return FakeBackup(backupDir, seed, fileSize).generate(files, albums, chats, messages, contacts, notes)
+
+
+def main():
+    desc = "Creates a synthetic iPhone backup to test and benchmark iphoneMatic\n" \
+           + "\nExample:  python3 fakeBackup.py --files 100000 /tmp/FakeBackup"
+    parser = argparse.ArgumentParser(description=desc, formatter_class=RawTextHelpFormatter)
+    parser.add_argument('backup_dir', help='Directory to create (it is deleted first if it exists)')
+    parser.add_argument('--files', type=int, default=10000, help="Number of files in Manifest.db (default: 10000)")
+    parser.add_argument('--albums', type=int, help="Number of albums in Photos.sqlite (default: files/2000)")
+    parser.add_argument('--chats', type=int, help="Number of Whatsapp chats (default: files/500)")
+    parser.add_argument('--messages', type=int, help="Number of Whatsapp text messages (default: files*2)")
+    parser.add_argument('--contacts', type=int, help="Number of contacts in AddressBook.sqlitedb (default: files/100)")
+    parser.add_argument('--notes', type=int, help="Number of notes in NoteStore.sqlite (default: files/1000)")
+    parser.add_argument('--file-size', type=int, default=4096, help="Average size in bytes of the files (default: 4096)")
+    parser.add_argument('--seed', type=int, default=1, help="The same seed creates the same backup (default: 1)")
+    args = parser.parse_args()
+
+    start = time.time()
+    counts = generateBackup(args.backup_dir, args.files, args.albums, args.chats, args.messages, args.contacts, args.notes,
+                            args.seed, args.file_size)
+    for kind, count in sorted(counts.items()):
+        print("{}: {}".format(kind, count))
+    print("Backup written to {} in {:.1f}s".format(args.backup_dir, time.time() - start))
+
+
+#Run program:
+if __name__ == "__main__":
+    main()
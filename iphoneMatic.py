@@ -25,17 +25,48 @@
 
 import os
 import shutil
+import io
+import gzip
+import tarfile
+import zipfile
+import tempfile
+import collections
 import sqlite3
 import argparse
 import pathlib
 import re
 import errno
 import html
+import zlib
+import hashlib
+import struct
+import array
+import mmap
+import time
+import json
+import itertools
+import subprocess
+import sys
+import cProfile
+import pstats
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from enum import Enum
 from datetime import datetime, timedelta
 from argparse import RawTextHelpFormatter
 from bplist import BPListReader
+import mediaprobe
 from sys import stderr, stdout, stdin
+try:
+    import fcntl     #Not available in Windows, used for reflinks
+except ImportError:
+    fcntl = None
+try:
+    import resource  #Not available in Windows, used for the peak memory
+except ImportError:
+    resource = None
 
 
 USE_COLORS = True
@@ -46,11 +77,89 @@ BLUE_COLOR = '\033[01;34m'  if USE_COLORS else ""
 RED_COLOR = '\033[01;31m' if USE_COLORS else ""
 NO_COLOR = '\033[00m'          if USE_COLORS else ""
 
+class Console:
+    #All the output goes through here, so -q and -v apply everywhere and the colours are used the
+    #same way: errors are always shown, in red. Lines about single files are only shown with -v
+    #(or --pretend, where they are the output); otherwise the progress line tells how far each phase
+    #is. Every event can also be written to a JSONL log, through a buffered writer.
+    QUIET = 0      #Errors and the final summary
+    NORMAL = 1     #Plus stages, warnings and progress
+    VERBOSE = 2    #Plus one line per file
+    EVENT_LOG_BUFFER = 1024 * 1024
+
+    def __init__(self):
+        self.level = self.NORMAL
+        self.showFiles = False
+        self.eventLog = None
+        self.lock = threading.Lock()
+        self.errors = 0
+        self.warnings = 0
+
+    def configure(self, level, showFiles=False, eventLogFilename=None):
+        self.level = level
+        self.showFiles = showFiles or level >= self.VERBOSE
+        if eventLogFilename != None:
+            self.eventLog = open(eventLogFilename, 'w', encoding='utf-8', buffering=self.EVENT_LOG_BUFFER)
+
+    def write(self, message, color=""):
+        with self.lock:
+            print(color + message + NO_COLOR if color != "" else message)
+
+    def event(self, kind, **fields):
+        if self.eventLog != None:
+            fields["time"] = round(time.time(), 3)
+            fields["event"] = kind
+            line = json.dumps(fields, default=str) + "\n"
+            with self.lock:
+                self.eventLog.write(line)
+
+    def error(self, message):
+        self.errors += 1
+        self.write(message, RED_COLOR)
+        self.event("error", message=message)
+
+    def warning(self, message):
+        self.warnings += 1
+        if self.level >= self.NORMAL:
+            self.write(message, RED_COLOR)
+        self.event("warning", message=message)
+
+    def banner(self, message):
+        if self.level >= self.NORMAL:
+            self.write(message, BLUE_COLOR)
+
+    def info(self, message):
+        if self.level >= self.NORMAL:
+            self.write(message)
+
+    def summary(self, message):
+        self.write(message)
+
+    def success(self, message):
+        self.write(message, GREEN_COLOR)
+
+    def file(self, message, kind, **fields):
+        if self.showFiles:
+            self.write(message)
+        self.event(kind, **fields)
+
+    def close(self):
+        if self.eventLog != None:
+            with self.lock:
+                self.eventLog.close()
+                self.eventLog = None
+
+console = Console()
+
 class PropertyType(Enum):
     PHONE = 3
     EMAIL = 4
     ADDRESS = 5
 
+def fileErrorMessage(destFile, e):
+    #Same text as the print("ERROR processing file", destFile, ": ", e, '\n'); print(e) of older versions:
+    return "ERROR processing file {} :  {} \n\n{}".format(destFile, e, e)
+
 def removePrefix(s, prefix):
     if s.startswith(prefix):
         s = s[len(prefix) : ]
@@ -104,12 +213,12 @@ def formatNames(first, middle, last):
     return s
 
 def writeToFile(filename, content):
-    print("Writing to", filename)
+    console.file("Writing to " + filename, "write", file=filename)
     try:
         with open(filename, 'w', encoding='utf-8') as file:
             file.write(content)
     except Exception as e:
-        print("Error writing note file: ", e)
+        console.error("Error writing file: " + filename + ": " + str(e))
 
 def ensureDirs(dirs):
     try:
@@ -118,115 +227,1816 @@ def ensureDirs(dirs):
         if exc.errno != errno.EEXIST:
             raise
 
+def decodeFileBlob(blob):
+    #Decodes the MBFile NSKeyedArchiver blob of a Manifest.db row.
+    #Returns (lastModified, fileSize, originalFilename, parseError, error). originalFilename
+    #is returned as the binary string found in the extended attributes.
+    lastModified = None
+    fileSize = None
+    originalFilename = None
+    parseError = False
+    parsed = {}
+    try:
+        reader = BPListReader(blob)
+        parsed = reader.parse()
+        #print(parsed)
+    except Exception as e:
+        parseError = True
+
+    try:
+        if "$objects" in parsed and len(parsed["$objects"]) >= 2:
+            if "LastModified" in parsed["$objects"][1]:
+                lastModified = parsed["$objects"][1]["LastModified"]
+            if "Size" in parsed["$objects"][1]:
+                fileSize = parsed["$objects"][1]["Size"]
+
+        if "$objects" in parsed and len(parsed["$objects"]) >= 4:
+            blobInside = parsed["$objects"][3]
+            parsedInside = None
+            try:
+                readerInside = BPListReader(blobInside)
+                parsedInside = readerInside.parse()
+                #print(parsedInside)
+            except Exception as e:
+                pass
+            if parsedInside != None and "com.apple.assetsd.originalFilename" in parsedInside:
+                originalFilename = parsedInside["com.apple.assetsd.originalFilename"]
+    except Exception as e:
+        return (None, None, None, parseError, str(e))
+    return (lastModified, fileSize, originalFilename, parseError, None)
+
+def decodeFileBlobs(blobs):
+    #Runs in the worker processes of IPhoneMatic.decodePool:
+    return [decodeFileBlob(blob) for blob in blobs]
+
+def decodeFileSize(blob):
+    #Reads only $objects[1].Size of an MBFile blob, following the offsets of the binary plist
+    #instead of parsing all of it. Falls back to decodeFileBlob() if the layout is unexpected.
+    try:
+        offsetSize, refSize, _, topObject, tableOffset = struct.unpack(">6xBBQQQ", blob[-32:])
+
+        def objectOffset(ref):
+            start = tableOffset + ref * offsetSize
+            return int.from_bytes(blob[start:start + offsetSize], "big")
+
+        def countAndStart(offset):
+            #Arrays, dicts and strings: count in the marker, or in an int that follows it
+            count = blob[offset] & 0x0F
+            if count != 0x0F:
+                return count, offset + 1
+            intSize = 1 << (blob[offset + 1] & 0x0F)
+            return int.from_bytes(blob[offset + 2:offset + 2 + intSize], "big"), offset + 2 + intSize
+
+        def ref(start, i):
+            return int.from_bytes(blob[start + i * refSize:start + (i + 1) * refSize], "big")
+
+        def dictValue(offset, key):
+            count, start = countAndStart(offset)
+            for i in range(count):
+                keyOffset = objectOffset(ref(start, i))
+                if blob[keyOffset] >> 4 == 0x5:   #ASCII string
+                    length, keyStart = countAndStart(keyOffset)
+                    if blob[keyStart:keyStart + length] == key:
+                        return objectOffset(ref(start, count + i))
+            return None
+
+        objects = dictValue(objectOffset(topObject), b"$objects")
+        count, start = countAndStart(objects)
+        sizeOffset = dictValue(objectOffset(ref(start, 1)), b"Size") if count >= 2 else None
+        if sizeOffset != None and blob[sizeOffset] >> 4 == 0x1:   #int
+            intSize = 1 << (blob[sizeOffset] & 0x0F)
+            return int.from_bytes(blob[sizeOffset + 1:sizeOffset + 1 + intSize], "big")
+    except Exception:
+        pass
+    return decodeFileBlob(blob)[1]
+
+LINK_STRATEGIES = ["auto", "hardlink", "reflink", "copy"]
+FICLONE = 0x40049409        #ioctl of btrfs, XFS, etc. that shares the data blocks of another file
+COPY_CHUNK = 16 * 1024 * 1024
+
+def reflinkFile(sourceFile, destFile):
+    if fcntl == None:
+        raise OSError(errno.EOPNOTSUPP, "reflinks are not supported in this platform", destFile)
+    with open(sourceFile, 'rb') as src:
+        with open(destFile, 'xb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except OSError:
+                dst.close()
+                os.remove(destFile)
+                raise
+
+def copyFileFast(sourceFile, destFile):
+    #Copies in the kernel when possible (copy_file_range, sendfile), in large chunks otherwise.
+    with open(sourceFile, 'rb') as src:
+        with open(destFile, 'xb') as dst:
+            try:
+                remaining = os.fstat(src.fileno()).st_size
+                offset = 0
+                #sendfile() only takes regular files as output in Linux, in macOS it has to be a socket:
+                inKernel = hasattr(os, "copy_file_range") or (hasattr(os, "sendfile") and sys.platform.startswith("linux"))
+                while remaining > 0 and inKernel:
+                    try:
+                        if hasattr(os, "copy_file_range"):
+                            n = os.copy_file_range(src.fileno(), dst.fileno(), min(remaining, COPY_CHUNK), offset, offset)
+                        else:
+                            n = os.sendfile(dst.fileno(), src.fileno(), offset, min(remaining, COPY_CHUNK))
+                    except OSError as exc:
+                        #Not supported between these filesystems, fall back to read/write:
+                        if offset == 0 and exc.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTSOCK):
+                            inKernel = False
+                            break
+                        raise
+                    if n == 0:
+                        break
+                    offset += n
+                    remaining -= n
+                if not inKernel:
+                    shutil.copyfileobj(src, dst, COPY_CHUNK)
+            except BaseException:
+                dst.close()
+                os.remove(destFile)
+                raise
+
+def createLink(sourceFile, destFile, strategy):
+    if strategy == "reflink":
+        reflinkFile(sourceFile, destFile)
+    elif strategy == "copy":
+        copyFileFast(sourceFile, destFile)
+    else:
+        os.link(sourceFile, destFile)
+
+def probeLinkStrategy(backup_dir, out_dir):
+    #Tries each strategy once, from the cheapest, linking Manifest.db into out_dir:
+    ensureDirs(out_dir)
+    sourceFile = os.path.join(backup_dir, "Manifest.db")
+    probeFile = os.path.join(out_dir, ".iphoneMatic_probe")
+    for strategy in ["hardlink", "reflink"]:
+        try:
+            if os.path.lexists(probeFile):
+                os.remove(probeFile)
+            createLink(sourceFile, probeFile, strategy)
+            os.remove(probeFile)
+            return strategy
+        except OSError:
+            pass
+    return "copy"
+
+ARCHIVE_FORMATS = {".tar": "tar", ".tar.gz": "tar.gz", ".tgz": "tar.gz", ".zip": "zip"}
+GZIP_BLOCK = 4 * 1024 * 1024
+
+def archiveFormat(filename):
+    for extension, archiveType in ARCHIVE_FORMATS.items():
+        if filename.lower().endswith(extension):
+            return archiveType
+    return None
+
+class ParallelGzipWriter:
+    #File object that gzips what is written to it in blocks of GZIP_BLOCK, compressed by a pool of
+    #threads (zlib releases the GIL). Every block is a gzip member of its own; a gzip file can be
+    #several members one after the other, gzip and tar read them as a single stream.
+    def __init__(self, file, jobs, compressLevel=6):
+        self.file = file
+        self.compressLevel = compressLevel
+        self.block = bytearray()
+        self.offset = 0
+        self.pool = ThreadPoolExecutor(max_workers=jobs)
+        self.maxPending = jobs * 2
+        self.pending = collections.deque()
+
+    def write(self, data):
+        self.block += data
+        self.offset += len(data)
+        while len(self.block) >= GZIP_BLOCK:
+            self.submit(bytes(self.block[:GZIP_BLOCK]))
+            del self.block[:GZIP_BLOCK]
+        return len(data)
+
+    def tell(self):
+        #Uncompressed offset, which is what tarfile keeps track of:
+        return self.offset
+
+    def submit(self, block):
+        self.pending.append(self.pool.submit(gzip.compress, block, self.compressLevel, mtime=0))
+        #The blocks are written in order, at most maxPending are compressed at the same time:
+        while len(self.pending) > self.maxPending:
+            self.file.write(self.pending.popleft().result())
+
+    def close(self):
+        if len(self.block) > 0:
+            self.submit(bytes(self.block))
+            self.block = bytearray()
+        while len(self.pending) > 0:
+            self.file.write(self.pending.popleft().result())
+        self.pool.shutdown()
+
+class ArchiveSink:
+    #Writes the extracted files into a single tar, tar.gz or zip file instead of linking them in out_dir,
+    #for targets without hardlinks (FAT, exFAT, network shares). Names inside the archive are the paths
+    #relative to out_dir, so the chats keep pointing to their media. Files are written one at a time,
+    #in the order of the plan; .tar.gz is compressed by a pool of threads. Zip entries of the backup
+    #files are stored (photos and videos are already compressed), the text exports are deflated.
+    def __init__(self, filename, out_dir, jobs=1):
+        self.out_dir = out_dir
+        self.archiveType = archiveFormat(filename)
+        if self.archiveType == None:
+            raise Exception("Unknown archive format, use .tar, .tar.gz, .tgz or .zip: " + filename)
+        self.lock = threading.Lock()
+        self.file = open(filename, 'wb')
+        self.gzip = None
+        self.tar = None
+        self.zip = None
+        if self.archiveType == "zip":
+            self.zip = zipfile.ZipFile(self.file, 'w', zipfile.ZIP_STORED, allowZip64=True)
+        else:
+            stream = self.file
+            if self.archiveType == "tar.gz":
+                stream = self.gzip = ParallelGzipWriter(self.file, max(1, jobs))
+            self.tar = tarfile.open(fileobj=stream, mode='w', format=tarfile.PAX_FORMAT, copybufsize=COPY_CHUNK)
+        self.files = 0
+
+    def archiveName(self, destFile):
+        return portablePath(destFile, self.out_dir)
+
+    def addFile(self, sourceFile, destFile, mtime):
+        with open(sourceFile, 'rb') as src:
+            size = os.fstat(src.fileno()).st_size
+            self.addEntry(destFile, size, mtime if mtime != None else os.fstat(src.fileno()).st_mtime, src, zipfile.ZIP_STORED)
+
+    def addData(self, destFile, data, mtime=None):
+        data = data.encode("utf-8") if isinstance(data, str) else data
+        self.addEntry(destFile, len(data), mtime if mtime != None else time.time(), io.BytesIO(data), zipfile.ZIP_DEFLATED)
+
+    def addEntry(self, destFile, size, mtime, src, zipCompression):
+        name = self.archiveName(destFile)
+        with self.lock:
+            if self.tar != None:
+                info = tarfile.TarInfo(name)
+                info.size = size
+                info.mtime = mtime
+                info.mode = 0o644
+                self.tar.addfile(info, src)
+            else:
+                #Zip dates can't be older than 1980:
+                info = zipfile.ZipInfo(name, time.localtime(max(mtime, 315532800))[:6])
+                info.compress_type = zipCompression
+                info.file_size = size
+                with self.zip.open(info, 'w') as dst:
+                    shutil.copyfileobj(src, dst, COPY_CHUNK)
+            self.files += 1
+
+    def close(self):
+        if self.tar != None:
+            self.tar.close()
+        if self.zip != None:
+            self.zip.close()
+        if self.gzip != None:
+            self.gzip.close()
+        self.file.close()
+
+def portablePath(path, root):
+    #Relative to root and with forward slashes, so plans can be applied on another machine:
+    return os.path.relpath(path, root).replace(os.sep, "/")
+
+def fromPortablePath(path, root):
+    return os.path.abspath(os.path.join(root, *path.split("/")))
+
+class LinkRecord:
+    #A file of the backup and the name it gets in out_dir.
+    __slots__ = ("source", "dest", "mtime", "size", "category", "album", "whatsappKey", "originalName", "domain", "relativePath")
+
+    def __init__(self, source, dest, mtime=None, size=None, category=None, album=None, whatsappKey=None, originalName=None,
+                 domain=None, relativePath=None):
+        self.source = source              #Absolute path of the file inside the backup
+        self.dest = dest                  #Absolute path of the link in out_dir
+        self.mtime = mtime                #LastModified, set as MTIME of the link
+        self.size = size
+        self.category = category          #Subdir of the ExtractRule (eg: "Camera")
+        self.album = album
+        self.whatsappKey = whatsappKey    #Media path as referenced by ChatStorage.sqlite
+        self.originalName = originalName  #com.apple.assetsd.originalFilename, if any
+        self.domain = domain              #Row of Manifest.db of the source
+        self.relativePath = relativePath
+
+    def toJson(self, backup_dir, out_dir):
+        return {"source": portablePath(self.source, backup_dir), "dest": portablePath(self.dest, out_dir),
+                "mtime": self.mtime, "size": self.size, "category": self.category, "album": self.album,
+                "whatsappKey": self.whatsappKey, "originalName": self.originalName,
+                "domain": self.domain, "relativePath": self.relativePath}
+
+    @classmethod
+    def fromJson(cls, d, backup_dir, out_dir):
+        return cls(fromPortablePath(d["source"], backup_dir), fromPortablePath(d["dest"], out_dir),
+                   d.get("mtime"), d.get("size"), d.get("category"), d.get("album"),
+                   d.get("whatsappKey"), d.get("originalName"), d.get("domain"), d.get("relativePath"))
+
+class LinkExecutor:
+    #Runs linkFile (stat, mkdir, link, utime) in a bounded thread pool.
+    #Naming is decided before submitting, so the result on disk doesn't depend on the number of jobs.
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.pool = None
+        if jobs > 1:
+            self.pool = ThreadPoolExecutor(max_workers=jobs)
+            self.maxPending = jobs * 8
+            self.slots = threading.BoundedSemaphore(self.maxPending)
+
+    def submit(self, fn, *args):
+        if self.pool == None:
+            fn(*args)
+            return
+        self.slots.acquire()   #Blocks when too many jobs are queued
+        future = self.pool.submit(fn, *args)
+        future.add_done_callback(lambda f: self.slots.release())
+
+    def wait(self):
+        #Waits until all submitted jobs finished:
+        if self.pool == None:
+            return
+        for i in range(self.maxPending):
+            self.slots.acquire()
+        for i in range(self.maxPending):
+            self.slots.release()
+
+    def shutdown(self):
+        if self.pool != None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+
+class ExtractionJournal:
+    #State database kept in out_dir, so that re-runs against the same backup skip the Manifest.db rows
+    #that didn't change since the last run, without decoding their blob or touching the filesystem.
+    #A row is identified by (fileID, subdir) and considered unchanged if the CRC of its MBFile blob
+    #(which holds LastModified and Size) is the same as recorded.
+    FILENAME = ".iphoneMatic_state.sqlite"
+    FLUSH_EVERY = 1000
+
+    def __init__(self, out_dir, settings, full, readOnly):
+        self.readOnly = readOnly
+        self.entries = {}        #(fileID, subdir) -> (blobCrc, destFile)
+        self.reservedNames = {}  #destFile -> (fileID, subdir)
+        self.pending = []
+        self.lock = threading.Lock()
+        self.conn = None
+        filename = os.path.join(out_dir, self.FILENAME)
+        if readOnly:
+            if not os.path.isfile(filename):
+                return
+            self.conn = sqlite3.connect(pathlib.Path(os.path.abspath(filename)).as_uri() + "?mode=ro", uri=True)
+        else:
+            ensureDirs(out_dir)
+            self.conn = sqlite3.connect(filename)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS Settings (key TEXT PRIMARY KEY, value TEXT)")
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(Links)")]
+            if len(columns) > 0 and "whatsappKey" not in columns:
+                #Journal of an older version, its rows are processed again:
+                self.conn.execute("DROP TABLE Links")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS Links (fileID TEXT, subdir TEXT, blobCrc INTEGER, " \
+                              + "lastModified REAL, size INTEGER, destFile TEXT, whatsappKey TEXT, PRIMARY KEY (fileID, subdir))")
+            #Dates read from inside the files by --probe-dates. They don't depend on the naming settings:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS MediaDates (fileID TEXT PRIMARY KEY, blobCrc INTEGER, date REAL)")
+        row = self.conn.execute("SELECT value FROM Settings WHERE key = 'naming'").fetchone()
+        if full or row == None or row[0] != settings:
+            #Names would come out different, start over:
+            if not readOnly:
+                self.conn.execute("DELETE FROM Links")
+                self.conn.execute("INSERT OR REPLACE INTO Settings VALUES ('naming', ?)", (settings,))
+                self.conn.commit()
+            return
+        for fileID, subdir, blobCrc, destFile in self.conn.execute("SELECT fileID, subdir, blobCrc, destFile FROM Links"):
+            self.entries[(fileID, subdir)] = (blobCrc, destFile)
+            self.reservedNames[destFile] = (fileID, subdir)
+
+    def lookup(self, key, blobCrc):
+        #Returns (unchangedDestFile, previousDestFile):
+        entry = self.entries.get(key)
+        if entry == None:
+            return None, None
+        if entry[0] == blobCrc:
+            return entry[1], entry[1]
+        return None, entry[1]
+
+    def isReservedByOther(self, destFile, key):
+        #Names of unchanged files from previous runs are kept for them:
+        owner = self.reservedNames.get(destFile)
+        return owner != None and owner != key
+
+    def whatsappPaths(self):
+        #Whatsapp media linked by previous runs, so chats can be exported when the Whatsapp
+        #category is skipped:
+        if self.conn == None or len(self.entries) == 0:
+            return {}
+        query = "SELECT whatsappKey, destFile FROM Links WHERE whatsappKey IS NOT NULL"
+        try:
+            return {whatsappKey: destFile for whatsappKey, destFile in self.conn.execute(query)}
+        except sqlite3.OperationalError:
+            #Read-only journal of an older version:
+            return {}
+
+    def mediaDates(self):
+        #fileID -> (blobCrc, date) of the files probed by previous runs. date is None if the file had none.
+        if self.conn == None:
+            return {}
+        try:
+            return {fileID: (blobCrc, date) for fileID, blobCrc, date in self.conn.execute("SELECT fileID, blobCrc, date FROM MediaDates")}
+        except sqlite3.OperationalError:
+            #Read-only journal of an older version:
+            return {}
+
+    def recordMediaDates(self, dates):
+        #dates is a list of (fileID, blobCrc, date):
+        if self.readOnly or len(dates) == 0:
+            return
+        self.conn.executemany("INSERT OR REPLACE INTO MediaDates VALUES (?, ?, ?)", dates)
+        self.conn.commit()
+
+    def record(self, key, blobCrc, lastModified, size, destFile, whatsappKey=None):
+        #Called from the link threads once the file is in place:
+        if self.readOnly:
+            return
+        with self.lock:
+            self.pending.append((key[0], key[1], blobCrc, lastModified, size, destFile, whatsappKey))
+
+    def flush(self, force=False):
+        if self.readOnly or (not force and len(self.pending) < self.FLUSH_EVERY):
+            return
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+        #Committed in batches, an interrupted run resumes from the last batch:
+        self.conn.executemany("INSERT OR REPLACE INTO Links VALUES (?, ?, ?, ?, ?, ?, ?)", pending)
+        self.conn.commit()
+
+    def close(self):
+        if self.conn != None:
+            self.flush(force=True)
+            self.conn.close()
+            self.conn = None
+
+class DecodedBlob:
+    #MBFile of a row of the manifest cache: what decodeFileBlob() would return for the blob,
+    #and the CRC of the blob for the journal.
+    __slots__ = ("decoded", "crc")
+
+    def __init__(self, decoded, crc):
+        self.decoded = decoded
+        self.crc = crc
+
+class ManifestCache:
+    #Decoded copy of the Files table of Manifest.db, kept in out_dir so that later runs (and
+    #--pretend, --plan and verify) don't query Manifest.db nor decode the MBFile blobs. Every field
+    #is a column stored as a flat array, and the arrays are used straight from a memory map:
+    #strings are a blob of UTF-8 plus an array of offsets. It is only used while the mtime and the
+    #size of Manifest.db are the ones it was built from. When they change, it is built again from the
+    #previous one: only the rows whose fileID or blob CRC changed are decoded.
+    FILENAME = ".iphoneMatic_manifest.cache"
+    MAGIC = b"iphoneMatic manifest cache\n"
+    VERSION = 2
+    COLUMNS = [("fileIDs", "B"), ("domains", "I"), ("flags", "b"), ("pathOffsets", "Q"), ("paths", "B"),
+               ("lastModified", "d"), ("sizes", "q"), ("nameOffsets", "Q"), ("names", "B"), ("blobCrcs", "I"), ("status", "B")]
+    #Bits of the status column:
+    PARSE_ERROR = 1
+    HAS_LAST_MODIFIED = 2
+    HAS_SIZE = 4
+    HAS_NAME = 8
+    ERROR = 16
+    BUILD_BATCH = 4096
+
+    def __init__(self, out_dir):
+        self.filename = os.path.join(out_dir, self.FILENAME)
+        self.count = 0
+        self.file = None
+        self.map = None
+        self.columns = {}
+
+    @staticmethod
+    def signature(manifestFilename):
+        #Reading all of Manifest.db to hash it would cost more than the rows it saves. The rows
+        #are checked by their CRC anyway when the cache is built again.
+        stat = os.stat(manifestFilename)
+        return {"mtime": stat.st_mtime_ns, "size": stat.st_size}
+
+    def load(self, signature):
+        #Returns False if there's no cache for this Manifest.db. With signature None, the cache
+        #of any Manifest.db is loaded (the previous one, for build()):
+        if not os.path.isfile(self.filename):
+            return False
+        self.file = open(self.filename, 'rb')
+        try:
+            if self.file.read(len(self.MAGIC)) != self.MAGIC:
+                return False
+            headerLength = struct.unpack("<Q", self.file.read(8))[0]
+            header = json.loads(self.file.read(headerLength))
+            if header["version"] != self.VERSION or header["byteorder"] != sys.byteorder \
+               or (signature != None and header["manifest"] != signature):
+                return False
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError, KeyError, struct.error):
+            return False
+        finally:
+            if self.map == None:
+                self.close()
+        view = memoryview(self.map)
+        for (name, typecode), (offset, length) in zip(self.COLUMNS, header["columns"]):
+            self.columns[name] = view[offset:offset + length].cast(typecode)
+        self.count = header["count"]
+        self.domainNames = header["domainNames"]
+        self.errors = {int(i): error for i, error in header["errors"].items()}
+        return True
+
+    def build(self, conn, decodeBlobs, signature, previous=None):
+        #Reads every row of Manifest.db (in Files order, like the scan of extractRules) and writes
+        #the cache. Rows with the same fileID and blob CRC as in previous (the loaded cache of an
+        #older Manifest.db) take their decoded values from it, the others are decoded with
+        #decodeBlobs, IPhoneMatic.decodeBlobs, to use the decoding processes. previous is closed.
+        columns = {name: array.array(typecode) for name, typecode in self.COLUMNS}
+        domainIds = {}
+        errors = {}
+        pathBytes = 0
+        nameBytes = 0
+        columns["pathOffsets"].append(0)
+        columns["nameOffsets"].append(0)
+        previousRows = {}
+        if previous != None:
+            previousIDs, previousCrcs = previous.columns["fileIDs"], previous.columns["blobCrcs"]
+            previousRows = {(bytes(previousIDs[i * 20:(i + 1) * 20]), previousCrcs[i]): i for i in range(previous.count)}
+        self.decodedCount = 0
+        rows = conn.cursor().execute("SELECT fileID, domain, relativePath, flags, file FROM Files")
+        for batch in iter(lambda: list(itertools.islice(rows, self.BUILD_BATCH)), []):
+            blobCrcs = [zlib.crc32(row[4]) if row[4] != None else 0 for row in batch]
+            previousIndexes = [previousRows.get((bytes.fromhex(row[0]), blobCrc)) for row, blobCrc in zip(batch, blobCrcs)]
+            toDecode = [row[4] for row, i in zip(batch, previousIndexes) if i == None]
+            self.decodedCount += len(toDecode)
+            decodedBlobs = iter(decodeBlobs(toDecode))
+            decodedList = [previous.decoded(i) if i != None else next(decodedBlobs) for i in previousIndexes]
+            for (fileID, domain, relativePath, flags, blob), decoded, blobCrc in zip(batch, decodedList, blobCrcs):
+                lastModified, fileSize, originalFilename, parseError, error = decoded
+                status = (self.PARSE_ERROR if parseError else 0) | (self.HAS_LAST_MODIFIED if lastModified != None else 0) \
+                         | (self.HAS_SIZE if fileSize != None else 0) | (self.HAS_NAME if originalFilename != None else 0)
+                if error != None:
+                    status |= self.ERROR
+                    errors[len(columns["status"])] = error
+                columns["fileIDs"].frombytes(bytes.fromhex(fileID))
+                if domain not in domainIds:
+                    domainIds[domain] = len(domainIds)
+                columns["domains"].append(domainIds[domain])
+                columns["flags"].append(flags if flags != None else -1)
+                path = relativePath.encode("utf-8") if relativePath != None else b""
+                columns["paths"].frombytes(path)
+                pathBytes += len(path)
+                columns["pathOffsets"].append(pathBytes)
+                columns["lastModified"].append(lastModified if lastModified != None else 0.0)
+                columns["sizes"].append(fileSize if fileSize != None else 0)
+                if originalFilename != None:
+                    columns["names"].frombytes(originalFilename)
+                    nameBytes += len(originalFilename)
+                columns["nameOffsets"].append(nameBytes)
+                columns["blobCrcs"].append(blobCrc)
+                columns["status"].append(status)
+        if previous != None:
+            #Before replacing its file, which can't be done while it's mapped in Windows:
+            previous.close()
+
+        header = {"version": self.VERSION, "byteorder": sys.byteorder, "manifest": signature,
+                  "count": len(columns["status"]), "domainNames": list(domainIds), "errors": errors, "columns": []}
+        #The columns start at multiples of 8, after the header (which has their offsets, so it has a fixed size):
+        headerLength = len(json.dumps(header)) + 64 * len(self.COLUMNS)
+        offset = len(self.MAGIC) + 8 + headerLength
+        for name, typecode in self.COLUMNS:
+            offset += -offset % 8
+            length = len(columns[name]) * columns[name].itemsize
+            header["columns"].append((offset, length))
+            offset += length
+        headerJson = json.dumps(header).encode("utf-8").ljust(headerLength)
+        tempFilename = self.filename + ".tmp"
+        with open(tempFilename, 'wb') as file:
+            file.write(self.MAGIC + struct.pack("<Q", headerLength) + headerJson)
+            for (name, typecode), (offset, length) in zip(self.COLUMNS, header["columns"]):
+                file.write(b"\0" * (offset - file.tell()))
+                columns[name].tofile(file)
+        os.replace(tempFilename, self.filename)
+        return self.load(signature)
+
+    def rows(self, domainFilter=None):
+        #Yields the rows as (fileID, domain, relativePath, flags, DecodedBlob), in Files order.
+        #domainFilter(domain) skips the rows of other domains before reading anything else.
+        c = self.columns
+        fileIDs, domains, flags, pathOffsets, paths = c["fileIDs"], c["domains"], c["flags"], c["pathOffsets"], c["paths"]
+        domainAccepted = [domainFilter == None or domainFilter(domain) for domain in self.domainNames]
+        for i in range(self.count):
+            if not domainAccepted[domains[i]]:
+                continue
+            yield (fileIDs[i * 20:(i + 1) * 20].hex(), self.domainNames[domains[i]],
+                   str(paths[pathOffsets[i]:pathOffsets[i + 1]], "utf-8"), flags[i], DecodedBlob(self.decoded(i), c["blobCrcs"][i]))
+
+    def files(self):
+        #Yields (fileID, domain, Size) of the rows that are files (flags 1), for verify:
+        c = self.columns
+        fileIDs, domains, flags, sizes, status = c["fileIDs"], c["domains"], c["flags"], c["sizes"], c["status"]
+        for i in range(self.count):
+            if flags[i] == 1:
+                yield (fileIDs[i * 20:(i + 1) * 20].hex(), self.domainNames[domains[i]], sizes[i] if status[i] & self.HAS_SIZE else None)
+
+    def decoded(self, i):
+        #Same tuple as decodeFileBlob():
+        c = self.columns
+        status = c["status"][i]
+        lastModified = c["lastModified"][i]
+        if lastModified.is_integer():
+            lastModified = int(lastModified)   #Like in the blob, where it's an integer
+        return (lastModified if status & self.HAS_LAST_MODIFIED else None,
+                c["sizes"][i] if status & self.HAS_SIZE else None,
+                bytes(c["names"][c["nameOffsets"][i]:c["nameOffsets"][i + 1]]) if status & self.HAS_NAME else None,
+                status & self.PARSE_ERROR != 0,
+                self.errors.get(i) if status & self.ERROR else None)
+
+    def close(self):
+        for column in self.columns.values():
+            column.release()
+        self.columns = {}
+        if self.map != None:
+            self.map.close()
+            self.map = None
+        if self.file != None:
+            self.file.close()
+            self.file = None
+
+class Progress:
+    #Tracks files/sec, bytes linked and errors per phase. Shows a live ETA line when stderr is a
+    #terminal, or a status line every few seconds otherwise (eg: a log file), and can write a JSON
+    #summary at the end of the run.
+    REFRESH_SECONDS = 0.5
+    STATUS_SECONDS = 10.0
+
+    def __init__(self, live=None, profiler=None):
+        self.live = stderr.isatty() if live == None else live
+        self.profiler = profiler   #StageProfiler with --profile
+        self.phases = []
+        self.current = None
+        self.lock = threading.Lock()
+        self.lastRefresh = 0
+        self.startTime = time.time()
+
+    @contextmanager
+    def phase(self, name, total=None):
+        p = {"name": name, "total": total, "done": 0, "bytes": 0, "errors": 0,
+             "start": time.time(), "seconds": 0.0}
+        self.phases.append(p)
+        self.current = p
+        if not self.live:
+            self.lastRefresh = p["start"]
+        try:
+            with self.profiler.stage(name) if self.profiler != None else nullcontext():
+                yield p
+        finally:
+            p["seconds"] = time.time() - p["start"]
+            p["peakRssMB"] = peakRssMB()
+            self.current = None
+            console.event("phase", name=name, total=p["total"], done=p["done"], bytes=p["bytes"],
+                          errors=p["errors"], seconds=round(p["seconds"], 3), peakRssMB=p["peakRssMB"])
+            if self.live:
+                stderr.write("\r\033[K")
+                stderr.flush()
+
+    def setTotal(self, total):
+        if self.current != None:
+            self.current["total"] = total
+
+    def advance(self, n=1):
+        if self.current != None:
+            self.current["done"] += n
+            self.refresh()
+
+    def addBytes(self, n):
+        #Called from the link threads:
+        p = self.current
+        if p != None and n != None:
+            with self.lock:
+                p["bytes"] += n
+
+    def error(self):
+        p = self.current
+        if p != None:
+            with self.lock:
+                p["errors"] += 1
+
+    def refresh(self):
+        now = time.time()
+        if console.level < Console.NORMAL or now - self.lastRefresh < (self.REFRESH_SECONDS if self.live else self.STATUS_SECONDS):
+            return
+        self.lastRefresh = now
+        p = self.current
+        elapsed = max(now - p["start"], 0.001)
+        rate = p["done"] / elapsed
+        line = "{}: {}".format(p["name"], p["done"])
+        if p["total"] != None and p["total"] > 0:
+            line += "/{} ({}%)".format(p["total"], p["done"] * 100 // p["total"])
+        line += ", {:.0f} files/s, {:.1f} MB linked, {} errors".format(rate, p["bytes"] / 1048576.0, p["errors"])
+        if p["total"] != None and rate > 0:
+            eta = max(p["total"] - p["done"], 0) / rate
+            line += ", ETA " + str(timedelta(seconds=int(eta)))
+        if self.live:
+            stderr.write("\r" + line + "\033[K")
+            stderr.flush()
+        else:
+            console.info(line)
+
+    def summary(self):
+        phases = []
+        for p in self.phases:
+            phases.append({"name": p["name"], "total": p["total"], "done": p["done"],
+                           "bytes": p["bytes"], "errors": p["errors"],
+                           "seconds": round(p["seconds"], 3), "peakRssMB": p.get("peakRssMB"),
+                           "filesPerSecond": round(p["done"] / p["seconds"], 1) if p["seconds"] > 0 else None})
+        return {"started": datetime.fromtimestamp(self.startTime).isoformat(),
+                "seconds": round(time.time() - self.startTime, 3),
+                "phases": phases}
+
+    def printSummary(self):
+        for p in self.phases:
+            rate = p["done"] / p["seconds"] if p["seconds"] > 0 else 0
+            line = "{}: {} files in {:.1f}s ({:.0f} files/s), {:.1f} MB linked, {} errors".format(
+                   p["name"], p["done"], p["seconds"], rate, p["bytes"] / 1048576.0, p["errors"])
+            if p.get("peakRssMB") != None:
+                line += ", peak RSS {:.0f} MB".format(p["peakRssMB"])
+            console.summary(line)
+
+    def writeJson(self, filename, extra=None):
+        summary = self.summary()
+        if extra != None:
+            summary.update(extra)
+        with open(filename, 'w', encoding='utf-8') as file:
+            json.dump(summary, file, indent=4)
+
+class StageProfiler:
+    #--profile DIR: runs every stage under cProfile and tracemalloc, and writes a .pstats file per
+    #stage plus report.txt with the time, memory and top allocation sites of each one. Nested
+    #stages (eg: the album index inside Camera) are left out of the stage that contains them.
+    #Only the main thread is profiled by cProfile, the link threads are not (tracemalloc sees them).
+    TOP_FUNCTIONS = 25
+    TOP_ALLOCATIONS = 10
+    TRACEBACK_FRAMES = 1
+    #Where the time goes, by the function or file that it is spent in:
+    AREAS = [("bplist", re.compile(r"bplist|plistlib")),
+             ("sqlite", re.compile(r"sqlite3")),
+             ("filesystem", re.compile(r"posix\.|nt\.|<built-in method io\.open>|<method '(read|write|close)' of '_io\.|shutil|genericpath|os\.py")),
+             ("html", re.compile(r"html"))]
+
+    def __init__(self, profileDir):
+        self.profileDir = profileDir
+        ensureDirs(profileDir)
+        self.stages = []
+        self.stack = []
+        tracemalloc.start(self.TRACEBACK_FRAMES)
+
+    def fileStem(self, number, name):
+        return os.path.join(self.profileDir, "{:02d}_{}".format(number, re.sub(r"[^A-Za-z0-9_.-]+", "_", name)))
+
+    @contextmanager
+    def stage(self, name):
+        if len(self.stack) > 0:
+            outer = self.stack[-1]
+            outer["profile"].disable()
+            outer["peak"] = max(outer["peak"], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        s = {"name": name, "number": len(self.stages) + 1, "peak": 0, "profile": cProfile.Profile(),
+             "snapshot": tracemalloc.take_snapshot(), "start": time.time(), "cpuStart": time.process_time()}
+        self.stages.append(s)
+        self.stack.append(s)
+        s["profile"].enable()
+        try:
+            yield s
+        finally:
+            s["profile"].disable()
+            s["seconds"] = time.time() - s["start"]
+            s["cpuSeconds"] = time.process_time() - s["cpuStart"]
+            s["peak"] = max(s["peak"], tracemalloc.get_traced_memory()[1])
+            s["allocations"] = tracemalloc.take_snapshot().compare_to(s["snapshot"], "lineno")[:self.TOP_ALLOCATIONS]
+            del s["snapshot"]
+            s["stats"] = pstats.Stats(s["profile"])
+            s["stats"].dump_stats(self.fileStem(s["number"], name) + ".pstats")
+            del s["profile"]
+            self.stack.pop()
+            if len(self.stack) > 0:
+                outer = self.stack[-1]
+                outer["peak"] = max(outer["peak"], s["peak"])
+                tracemalloc.reset_peak()
+                outer["profile"].enable()
+
+    def areas(self, stats):
+        seconds = {area: 0.0 for area, pattern in self.AREAS}
+        seconds["other"] = 0.0
+        for (filename, lineno, function), (cc, nc, tottime, cumtime, callers) in stats.stats.items():
+            where = filename + " " + function
+            for area, pattern in self.AREAS:
+                if pattern.search(where):
+                    seconds[area] += tottime
+                    break
+            else:
+                seconds["other"] += tottime
+        return seconds
+
+    def writeReport(self):
+        tracemalloc.stop()
+        filename = os.path.join(self.profileDir, "report.txt")
+        with open(filename, 'w', encoding='utf-8') as report:
+            report.write("Stage                          Wall s    CPU s  Peak MB  " \
+                         + "  ".join("{:>12}".format(area + " s") for area, pattern in self.AREAS + [("other", None)]) + "\n")
+            for s in self.stages:
+                areas = self.areas(s["stats"])
+                report.write("{:<28} {:8.2f} {:8.2f} {:8.1f}  ".format(s["name"][:28], s["seconds"], s["cpuSeconds"], s["peak"] / 1048576.0) \
+                             + "  ".join("{:12.2f}".format(seconds) for seconds in areas.values()) + "\n")
+            for s in self.stages:
+                report.write("\n\n===== {} ({}) =====\n".format(s["name"], os.path.basename(self.fileStem(s["number"], s["name"])) + ".pstats"))
+                report.write("\nTop allocation sites (memory still held at the end of the stage):\n")
+                for stat in s["allocations"]:
+                    report.write("    {}\n".format(stat))
+                s["stats"].stream = report
+                s["stats"].sort_stats("cumulative").print_stats(self.TOP_FUNCTIONS)
+        console.info("Profile written to " + filename)
+
+class FsSnapshot:
+    #Answers the existence checks of the link stage from memory: the backup shard dirs and the
+    #existing out_dir tree are listed once with os.scandir, and the files and dirs created during
+    #the run are added as they are created. Counts the syscalls done and the ones avoided.
+    def __init__(self, backup_dir, out_dir, enabled=True):
+        self.backup_dir = backup_dir
+        self.out_dir = out_dir
+        self.enabled = enabled
+        self.sourceFiles = None
+        self.destFiles = None
+        self.destDirs = None
+        self.lock = threading.Lock()
+        self.checks = 0     #Existence checks, each one was a stat before
+        self.syscalls = 0   #Syscalls actually done for them (scandir, stat)
+
+    def key(self, path):
+        return os.path.normcase(path)
+
+    def scanSources(self):
+        #Shard dirs are named after the first 2 chars of the fileID (00 to ff):
+        self.sourceFiles = PathMap()
+        self.syscalls += 1
+        try:
+            shardDirs = [entry.path for entry in os.scandir(self.backup_dir) \
+                         if len(entry.name) == 2 and entry.is_dir()]
+        except OSError:
+            shardDirs = []
+        for shardDir in shardDirs:
+            self.syscalls += 1
+            with os.scandir(shardDir) as it:
+                for entry in it:
+                    if entry.is_file():
+                        self.sourceFiles.add(self.key(os.path.abspath(entry.path)))
+
+    def scanDest(self):
+        self.destFiles = PathMap()
+        self.destDirs = set()
+        pendingDirs = [os.path.abspath(self.out_dir)]
+        self.syscalls += 1
+        if not os.path.isdir(pendingDirs[0]):
+            return
+        self.destDirs.add(self.key(pendingDirs[0]))
+        while len(pendingDirs) > 0:
+            dirName = pendingDirs.pop()
+            self.syscalls += 1
+            try:
+                with os.scandir(dirName) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            self.destDirs.add(self.key(entry.path))
+                            pendingDirs.append(entry.path)
+                        elif entry.is_file():
+                            self.destFiles.add(self.key(entry.path))
+            except OSError:
+                pass
+
+    def sourceExists(self, sourceFile):
+        self.checks += 1
+        if not self.enabled:
+            self.syscalls += 1
+            return os.path.isfile(sourceFile)
+        if self.sourceFiles == None:
+            self.scanSources()
+        return self.key(sourceFile) in self.sourceFiles
+
+    def ensureDestScanned(self):
+        if self.destFiles == None:
+            with self.lock:
+                if self.destFiles == None:
+                    self.scanDest()
+
+    def destIsFile(self, destFile):
+        self.checks += 1
+        if not self.enabled:
+            self.syscalls += 1
+            return os.path.isfile(destFile)
+        self.ensureDestScanned()
+        return self.key(destFile) in self.destFiles
+
+    def destDirExists(self, dirName):
+        self.checks += 1
+        if not self.enabled:
+            self.syscalls += 1
+            return os.path.exists(dirName)
+        self.ensureDestScanned()
+        return self.key(dirName) in self.destDirs
+
+    def addedFile(self, destFile):
+        if self.enabled:
+            self.ensureDestScanned()
+            self.destFiles.add(self.key(destFile))
+
+    def removedFile(self, destFile):
+        if self.enabled:
+            self.ensureDestScanned()
+            self.destFiles.discard(self.key(destFile))
+
+    def addedDir(self, dirName):
+        #ensureDirs() also creates the parents:
+        if self.enabled:
+            self.ensureDestScanned()
+            while self.key(dirName) not in self.destDirs:
+                self.destDirs.add(self.key(dirName))
+                parent = os.path.dirname(dirName)
+                if parent == dirName:
+                    break
+                dirName = parent
+
+    def report(self):
+        console.info("Filesystem existence checks: {} stat calls before, {} syscalls now".format(self.checks, self.syscalls))
+
+class ContentIndex:
+    #Index of file contents shared by the extractions of several snapshots of the same device.
+    #A new file whose content is already in an older out_dir is hardlinked from there instead of
+    #from the new backup, so the old backup directories can be deleted without losing data.
+    #Candidates are found by size and a fast hash (start and end of the file), and confirmed by
+    #a hash of the full content. The MTIME must be the same too, as the links share it.
+    MIN_SIZE = 64 * 1024    #Smaller files are not worth hashing
+    SAMPLE_SIZE = 64 * 1024
+    COMMIT_EVERY = 500
+
+    def __init__(self, filename):
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS Content (path TEXT PRIMARY KEY, size INTEGER, " \
+                          + "mtime REAL, fastHash TEXT, fullHash TEXT)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ContentBySize ON Content (size, fastHash)")
+        self.conn.commit()
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        self.hits = 0
+        self.bytesSaved = 0
+
+    def fastHash(self, filename, size):
+        h = hashlib.blake2b(str(size).encode(), digest_size=16)
+        with open(filename, 'rb') as file:
+            h.update(file.read(self.SAMPLE_SIZE))
+            if size > self.SAMPLE_SIZE * 2:
+                file.seek(size - self.SAMPLE_SIZE)
+                h.update(file.read(self.SAMPLE_SIZE))
+        return h.hexdigest()
+
+    def fullHash(self, filename):
+        h = hashlib.blake2b(digest_size=32)
+        with open(filename, 'rb') as file:
+            while True:
+                chunk = file.read(COPY_CHUNK)
+                if not chunk:
+                    break
+                h.update(chunk)
+        return h.hexdigest()
+
+    def findIdentical(self, sourceFile, size, mtime):
+        #Returns (indexedFile, fastHash, fullHash). indexedFile is None if the content is new.
+        if size == None or size < self.MIN_SIZE:
+            return None, None, None
+        fastHash = self.fastHash(sourceFile, size)
+        with self.lock:
+            candidates = self.conn.execute("SELECT path, fullHash FROM Content WHERE size = ? AND fastHash = ? AND mtime IS ?",
+                                           (size, fastHash, mtime)).fetchall()
+        if len(candidates) == 0:
+            return None, fastHash, None
+        fullHash = self.fullHash(sourceFile)
+        for path, candidateHash in candidates:
+            if not os.path.isfile(path):
+                with self.lock:
+                    self.conn.execute("DELETE FROM Content WHERE path = ?", (path,))
+                continue
+            if candidateHash == None:
+                candidateHash = self.fullHash(path)
+                with self.lock:
+                    self.conn.execute("UPDATE Content SET fullHash = ? WHERE path = ?", (candidateHash, path))
+            if candidateHash == fullHash:
+                return path, fastHash, fullHash
+        return None, fastHash, fullHash
+
+    def add(self, path, size, mtime, fastHash, fullHash, deduplicated):
+        if fastHash == None:
+            return
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO Content VALUES (?, ?, ?, ?, ?)", (path, size, mtime, fastHash, fullHash))
+            if deduplicated:
+                self.hits += 1
+                self.bytesSaved += size
+            self.uncommitted += 1
+            if self.uncommitted >= self.COMMIT_EVERY:
+                self.conn.commit()
+                self.uncommitted = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+    def report(self):
+        console.info("Deduplicated: {} files ({:.1f} MB) linked from previous snapshots".format(self.hits, self.bytesSaved / 1048576.0))
+
+class ExportIndex:
+    #Sidecar database in out_dir with the backup file each extracted file came from, read by the lookup
+    #command. Destinations are relative to out_dir. Files skipped because they didn't change keep the
+    #rows of the run that linked them, so the index is only cleared when every file is linked again.
+    FILENAME = ".iphoneMatic_index.sqlite"
+    COMMIT_EVERY = 1000
+
+    def __init__(self, filename, root, clear):
+        self.root = root
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS Exports (dest TEXT PRIMARY KEY, name TEXT, fileID TEXT, domain TEXT, " \
+                          + "relativePath TEXT, size INTEGER, mtime REAL, category TEXT)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ExportsByName ON Exports (name)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ExportsByFileID ON Exports (fileID)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ExportsByPath ON Exports (relativePath)")
+        if clear:
+            self.conn.execute("DELETE FROM Exports")
+        self.conn.commit()
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+
+    def add(self, record):
+        dest = portablePath(record.dest, self.root)
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO Exports VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                              (dest, dest.rsplit("/", 1)[-1], os.path.basename(record.source), record.domain,
+                               record.relativePath, record.size, record.mtime, record.category))
+            self.uncommitted += 1
+            if self.uncommitted >= self.COMMIT_EVERY:
+                self.conn.commit()
+                self.uncommitted = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+def isGlob(pattern):
+    return any(c in pattern for c in "*?[")
+
+def lookupExports(conn, term, source=False):
+    #Rows of the export index for a term: a fileID, or with source=True a relativePath of the backup
+    #(forward), or a name or path relative to out_dir (reverse). Terms with * ? [ are globs.
+    columns = "SELECT dest, fileID, domain, relativePath, size, mtime, category FROM Exports "
+    term = term.replace("\\", "/")
+    if re.fullmatch("[0-9a-fA-F]{40}", term):
+        return conn.execute(columns + "WHERE fileID = ? ORDER BY dest", (term.lower(),)).fetchall()
+    operator = "GLOB" if isGlob(term) else "="
+    if source:
+        return conn.execute(columns + "WHERE relativePath {} ? ORDER BY dest".format(operator), (term,)).fetchall()
+    if "/" in term:
+        return conn.execute(columns + "WHERE dest {} ? ORDER BY dest".format(operator), (term.strip("/"),)).fetchall()
+    return conn.execute(columns + "WHERE name {} ? ORDER BY dest".format(operator), (term,)).fetchall()
+
+class TimedCursor(sqlite3.Cursor):
+    #Adds the time spent inside SQLite (execute and fetching the rows) to the stats of its database.
+    #Rows are fetched in batches, so timing them costs little even on Manifest.db scans.
+    FETCH_BATCH = 1024
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.connection.addTime(time.perf_counter() - start, queries=1)
+
+    def __iter__(self):
+        while True:
+            start = time.perf_counter()
+            rows = self.fetchmany(self.FETCH_BATCH)
+            self.connection.addTime(time.perf_counter() - start, rows=len(rows))
+            if len(rows) == 0:
+                return
+            yield from rows
+
+class TimedConnection(sqlite3.Connection):
+    stats = None
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def addTime(self, seconds, queries=0, rows=0):
+        if self.stats != None:
+            self.stats["queries"] += queries
+            self.stats["rows"] += rows
+            self.stats["seconds"] += seconds
+
+class SourceDatabases:
+    #Connections to the databases read from the backup (Manifest.db, Photos.sqlite, ChatStorage.sqlite,
+    #...), opened once and shared by all the stages. They are opened read-only with immutable=1: the
+    #files don't change while we read them, so SQLite takes no locks and never writes -wal or -shm
+    #files next to the backup. The pragmas favour long sequential scans.
+    MMAP_SIZE = 256 * 1024 * 1024
+    CACHE_KB = 64 * 1024
+
+    def __init__(self):
+        self.connections = {}   #normcase(abspath) -> TimedConnection
+        self.stats = {}         #name -> {"queries", "rows", "seconds"}
+
+    def connect(self, filename, name=None):
+        #name is the one shown in the timings, files in the backup are named by their hash.
+        key = os.path.normcase(os.path.abspath(filename))
+        conn = self.connections.get(key)
+        if conn == None:
+            uri = pathlib.Path(os.path.abspath(filename)).as_uri() + "?mode=ro&immutable=1"
+            conn = sqlite3.connect(uri, uri=True, factory=TimedConnection)
+            conn.execute("PRAGMA mmap_size = {}".format(self.MMAP_SIZE))
+            conn.execute("PRAGMA cache_size = -{}".format(self.CACHE_KB))
+            conn.execute("PRAGMA temp_store = MEMORY")
+            name = name if name != None else os.path.basename(filename)
+            conn.stats = self.stats.setdefault(name, {"queries": 0, "rows": 0, "seconds": 0.0})
+            self.connections[key] = conn
+        return conn
+
+    def close(self):
+        for conn in self.connections.values():
+            conn.close()
+        self.connections = {}
+
+    def report(self):
+        for name, stats in self.stats.items():
+            console.info("SQLite {}: {} queries, {} rows in {:.2f}s".format(name, stats["queries"], stats["rows"], stats["seconds"]))
+
+def peakRssMB():
+    #Peak resident memory of this process so far, None if it can't be known (Windows):
+    if resource == None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1048576.0 if sys.platform == "darwin" else maxrss / 1024.0   #bytes in macOS, KB in Linux
+
+class CompactPath:
+    #A path kept as (directory, name). The directory string is interned by DirNames, so the files
+    #of a directory share it instead of each one holding the full path.
+    __slots__ = ("dir", "name")
+
+    def __init__(self, dirName, name):
+        self.dir = dirName
+        self.name = name
+
+    def __fspath__(self):
+        return os.path.join(self.dir, self.name)
+
+    __str__ = __fspath__
+
+class DirNames:
+    def __init__(self):
+        self.names = {}
+
+    def compact(self, path):
+        dirName, name = os.path.split(path)
+        return CompactPath(self.names.setdefault(dirName, dirName), name)
+
+class PathMap:
+    #dict of path -> value, stored as {directory: {name: value}} so every directory name is kept once.
+    #Used as a set with add(), discard() and "in". Thread safe like a dict for the link threads.
+    def __init__(self):
+        self.dirs = {}
+
+    def __contains__(self, path):
+        if path == None:
+            return False
+        dirName, name = os.path.split(path)
+        names = self.dirs.get(dirName)
+        return names != None and name in names
+
+    def get(self, path, default=None):
+        if path == None:
+            return default
+        dirName, name = os.path.split(path)
+        names = self.dirs.get(dirName)
+        return names.get(name, default) if names != None else default
+
+    def __getitem__(self, path):
+        dirName, name = os.path.split(path)
+        return self.dirs[dirName][name]
+
+    def __setitem__(self, path, value):
+        dirName, name = os.path.split(path)
+        names = self.dirs.get(dirName)
+        if names == None:
+            names = self.dirs.setdefault(dirName, {})
+        names[name] = value
+
+    def add(self, path):
+        self[path] = True
+
+    def discard(self, path):
+        dirName, name = os.path.split(path)
+        names = self.dirs.get(dirName)
+        if names != None:
+            names.pop(name, None)
+
+    def __len__(self):
+        return sum(len(names) for names in self.dirs.values())
+
+    def items(self):
+        for dirName, names in self.dirs.items():
+            for name, value in names.items():
+                yield os.path.join(dirName, name), value
+
+class WhatsappDocument:
+    #Row of ZWAMEDIAITEM, only the columns used to name the documents and find their thumbnails.
+    __slots__ = ("originalFilename", "thumbnailPath")
+
+    def __init__(self, originalFilename, thumbnailPath):
+        self.originalFilename = originalFilename
+        self.thumbnailPath = thumbnailPath
+
+class FilenameAllocator:
+    #Hands out unique filenames, adding _1, _2, ... to the names already taken.
+    #It remembers the next suffix to try for each (dir, name, extension), so k files with the
+    #same name cost O(k) instead of probing _1, _2, ... again for every one of them.
+    #Suffixes below the remembered one are always taken, so the names are the same as probing from _1.
+    def __init__(self, isReserved=None):
+        self.taken = PathMap() #filename -> value (eg: fileID of the source)
+        self.nextSuffix = {}   #(dir, name, extension) -> n
+        self.isReserved = isReserved
+
+    def __contains__(self, filename):
+        return filename in self.taken
+
+    def add(self, filename, value=1):
+        self.taken[filename] = value
+
+    def isAvailable(self, filename, owner):
+        if filename in self.taken:
+            return False
+        return self.isReserved == None or not self.isReserved(filename, owner)
+
+    def allocate(self, filename, value=1, owner=None, dirName=None):
+        #Returns filename, or filename with a _N suffix if it is already taken.
+        #owner is passed to isReserved(), dirName overrides the directory of the suffixed names.
+        if not self.isAvailable(filename, owner):
+            p = pathlib.Path(filename)
+            extension = p.suffix
+            name = p.stem
+            if dirName == None:
+                dirName = str(p.parent)
+            key = (dirName, name, extension)
+            n = self.nextSuffix.get(key, 1)
+            while os.path.join(dirName, name + "_" + str(n) + extension) in self.taken:
+                n += 1
+            self.nextSuffix[key] = n
+            filename = os.path.join(dirName, name + "_" + str(n) + extension)
+            while not self.isAvailable(filename, owner):
+                n += 1
+                filename = os.path.join(dirName, name + "_" + str(n) + extension)
+        self.taken[filename] = value
+        return filename
+
+def likeToRegex(pattern):
+    #Translates an SQL LIKE pattern into a regex with the same semantics as sqlite
+    #(% and _ wildcards, case insensitive for ASCII only):
+    regex = ""
+    for c in pattern:
+        if c == "%":
+            regex += ".*"
+        elif c == "_":
+            regex += "."
+        else:
+            regex += re.escape(c)
+    return re.compile(regex, re.IGNORECASE | re.ASCII | re.DOTALL)
+
+class ExtractRule:
+    def __init__(self, subdir, domainFilter, pathFilter, typeStr, banner=None, thumbnailSubdir=None, stickersSubdir=None):
+        self.subdir = subdir
+        self.domainFilter = domainFilter
+        self.pathFilter = pathFilter
+        self.typeStr = typeStr
+        self.banner = banner
+        self.thumbnailSubdir = thumbnailSubdir
+        self.stickersSubdir = stickersSubdir
+        self.domainRegex = likeToRegex(domainFilter)
+        self.pathRegex = likeToRegex(pathFilter)
+        self.domainMatches = {}   #Cache, there are only a few hundred distinct domains
+
+    def matches(self, domain, relpath):
+        if domain == None or relpath == None:   #NULL LIKE x is never true
+            return False
+        matched = self.domainMatches.get(domain)
+        if matched == None:
+            matched = self.domainRegex.fullmatch(domain) != None
+            self.domainMatches[domain] = matched
+        return matched and self.pathRegex.fullmatch(relpath) != None
+
+class AlbumIndex:
+    #Albums of the camera pictures, from Photos.sqlite. Pictures are grouped by ZDIRECTORY, so the
+    #directory names aren't repeated for every picture, and map to a tuple with the paths of their
+    #albums. The tuples are shared by all the pictures in the same albums.
+    def __init__(self):
+        self.byDirectory = {}    #ZDIRECTORY -> {ZFILENAME -> (main album path, other album paths...)}
+        self.albumSets = {}      #Shared tuples
+        self.albumCount = 0
+
+    def load(self, conn):
+        albums = {}              #Z_PK -> (title, parent folder Z_PK)
+        query = "SELECT album.Z_PK, album.ZTITLE, album.ZPARENTFOLDER FROM ZGENERICALBUM album"
+        for albumId, albumTitle, parentFolderId in conn.execute(query):
+            albums[albumId] = (albumTitle if albumTitle != None else "(noname)", parentFolderId)
+        self.albumCount = len(albums)
+
+        folderPaths = {}
+        albumPaths = {}
+        for albumId, (albumTitle, parentFolderId) in albums.items():
+            folderPath = self.folderPath(albums, folderPaths, parentFolderId)
+            albumPaths[albumId] = os.path.join(folderPath, albumTitle) if folderPath != "" else albumTitle
+
+        #Sorted by title, the last album of a picture is the main one (its subdir of Camera/)
+        query = "SELECT album.Z_PK, za.ZDIRECTORY, za.ZFILENAME " \
+                + "FROM Z_33ASSETS aa " \
+                + "INNER JOIN ZGENERICALBUM album ON album.Z_PK = aa.Z_33ALBUMS " \
+                + "INNER JOIN ZASSET za ON za.Z_PK = aa.Z_3ASSETS " \
+                + "ORDER BY album.ZTITLE"
+        for albumId, imageDirectory, imageFilename in conn.execute(query):
+            files = self.byDirectory.get(imageDirectory)
+            if files == None:
+                files = self.byDirectory[imageDirectory] = {}
+            albumPath = albumPaths[albumId]
+            paths = (albumPath,) + tuple(path for path in files.get(imageFilename, ()) if path != albumPath)
+            files[imageFilename] = self.albumSets.setdefault(paths, paths)
+
+    def folderPath(self, albums, folderPaths, folderId):
+        #Path of the folders containing an album, without the root folder. Memoised in folderPaths,
+        #so every folder is resolved once however many albums it has.
+        chain = []
+        while folderId in albums and folderId not in folderPaths and folderId not in chain:
+            chain.append(folderId)
+            folderId = albums[folderId][1]
+        path = folderPaths.get(folderId, "")
+        for folderId in reversed(chain):
+            folderTitle, parentFolderId = albums[folderId]
+            if parentFolderId != None:   #Don't add root dir as "(noname)"
+                path = os.path.join(path, folderTitle) if path != "" else folderTitle
+            folderPaths[folderId] = path
+        return path
+
+    def albumsOf(self, imagePath):
+        #imagePath is ZDIRECTORY/ZFILENAME. Returns () if the picture isn't in any album.
+        imageDirectory, _, imageFilename = imagePath.rpartition("/")
+        files = self.byDirectory.get(imageDirectory)
+        if files == None:
+            return ()
+        return files.get(imageFilename, ())
+
+class PhotoAssets:
+    #Capture date and original name of the camera pictures, from Photos.sqlite, grouped by ZDIRECTORY
+    #like in AlbumIndex. Camera files found here are named without decoding their MBFile blob (only
+    #their Size is read from it), and with the time the picture was taken instead of the mtime of the file.
+    def __init__(self):
+        self.byDirectory = {}    #ZDIRECTORY -> {ZFILENAME -> (date, originalFilename)}
+        self.count = 0
+
+    def load(self, conn):
+        query = "SELECT za.ZDIRECTORY, za.ZFILENAME, za.ZDATECREATED, attr.ZORIGINALFILENAME " \
+                + "FROM ZASSET za " \
+                + "LEFT JOIN ZADDITIONALASSETATTRIBUTES attr ON attr.ZASSET = za.Z_PK " \
+                + "WHERE za.ZDATECREATED IS NOT NULL"
+        for imageDirectory, imageFilename, dateCreated, originalFilename in conn.execute(query):
+            files = self.byDirectory.get(imageDirectory)
+            if files == None:
+                files = self.byDirectory[imageDirectory] = {}
+            #The original filename comes as a binary string from the blob, keep it the same:
+            files[imageFilename] = (dateCreated + 978307200, originalFilename.encode("utf-8") if originalFilename != None else None)
+            self.count += 1
+
+    def decodedOf(self, imagePath, fileSize):
+        #imagePath is ZDIRECTORY/ZFILENAME, fileSize comes from the MBFile. Returns a tuple like the one
+        #of decodeFileBlob(), or None if the picture isn't in Photos.sqlite.
+        imageDirectory, _, imageFilename = imagePath.rpartition("/")
+        files = self.byDirectory.get(imageDirectory)
+        if files == None:
+            return None
+        asset = files.get(imageFilename)
+        if asset == None:
+            return None
+        return (asset[0], fileSize, asset[1], False, None)
+
+#Order matters: Whatsapp needs ChatStorage.sqlite, which is linked by FilesAppGroups.
+EXTRACT_RULES = [
+    ExtractRule("Camera", "CameraRollDomain", "%Media/DCIM%", "TypePhotos",
+                banner="Extracting links to camera pictures..."),
+    ExtractRule("FTPManager", "AppDomainGroup-group.com.skyjos.ftpmanager", "%", "TypeApp"),
+    ExtractRule("Files", "AppDomainGroup-group.com.apple.FileProvider.LocalStorage", "%", "TypeApp"),
+    ExtractRule("FilesHome", "HomeDomain", "%", "TypeApp"),
+    ExtractRule("FilesAppGroups", "AppDomainGroup-%", "%", "TypeAppGroup"),
+    #Some Thumbnails:
+    #    ExtractRule("FromMac", "CameraRollDomain", "%Media/PhotoData/Thumbnails/V2/PhotoData/Sync/100SYNCD/%", "TypeNormal"),
+    #More Thumbnails:
+    #    ExtractRule("Thumbnails", "CameraRollDomain", "%Media/PhotoData/Metadata/PhotoData/Sync/100SYNCD/%", "TypeNormal"),
+    ExtractRule("WhatsappProfilePictures", "AppDomainGroup-group.net.whatsapp.WhatsApp.shared", "%Media/Profile/%jpg", "TypeNormal",
+                banner="Extracting links to whatsapp pictures..."),
+    ExtractRule("Whatsapp", "AppDomainGroup-group.net.whatsapp.WhatsApp.shared", "%Message/Media%", "TypeWhatsapp",
+                thumbnailSubdir="WhatsappThumbnails", stickersSubdir="WhatsappStickers"),
+]
+
+#Categories whose photos and videos are named by their embedded date with --probe-dates:
+PROBE_CATEGORIES = ["FTPManager", "Files", "FilesAppGroups"]
+
+#Stages after the links, selectable with --only/--skip like the rules:
+EXPORT_CATEGORIES = ["Notes", "Contacts", "WhatsappChats"]
+CATEGORIES = [rule.subdir for rule in EXTRACT_RULES] + EXPORT_CATEGORIES
+
+#Databases read by the exports: (path in out_dir, domain, relativePath in Manifest.db)
+WHATSAPP_CHATS_DB = ("FilesAppGroups/group.net.whatsapp.WhatsApp.shared/ChatStorage.sqlite",
+                     "AppDomainGroup-group.net.whatsapp.WhatsApp.shared", "ChatStorage.sqlite")
+WHATSAPP_CONTACTS_DB = ("FilesAppGroups/group.net.whatsapp.WhatsApp.shared/ContactsV2.sqlite",
+                        "AppDomainGroup-group.net.whatsapp.WhatsApp.shared", "ContactsV2.sqlite")
+NOTES_DB = ("FilesAppGroups/group.com.apple.notes/NoteStore.sqlite", "AppDomainGroup-group.com.apple.notes", "NoteStore.sqlite")
+CONTACTS_DB = ("FilesHome/Library/AddressBook/AddressBook.sqlitedb", "HomeDomain", "Library/AddressBook/AddressBook.sqlitedb")
+
+def parseCategories(names):
+    #Comma separated, case insensitive. Returns the canonical names.
+    byLower = {category.lower(): category for category in CATEGORIES}
+    result = []
+    for name in names.split(","):
+        name = name.strip()
+        if name == "":
+            continue
+        if name.lower() not in byLower:
+            raise argparse.ArgumentTypeError("unknown category '{}', choose from: {}".format(name, ", ".join(CATEGORIES)))
+        result.append(byLower[name.lower()])
+    return result
+
+def parseSince(value):
+    #YYYY-MM-DD or an ISO date and time, local time. Returns a unix timestamp.
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid date '{}', use YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS".format(value))
+
 class IPhoneMatic:
-    def __init__(self, backup_dir, out_dir, dryRun, preserveNames, ignoreAlbums):
+    DECODE_BATCH = 4096   #Rows decoded at a time
+    DECODE_CHUNK = 256    #Rows per task sent to each decoding process
+    PROBE_THREADS = 8     #Threads reading the dates inside app files with --probe-dates
+
+    def __init__(self, backup_dir, out_dir, dryRun, preserveNames, ignoreAlbums, jobs=1, full=False, procs=1, fsCache=True, planFile=None,
+                 linkStrategy="hardlink", dedupIndex=None, since=None, profileDir=None, manifestCache=True, probeDates=False,
+                 archiveFile=None, writeState=True):
         self.backup_dir = backup_dir
         self.out_dir = out_dir
         self.dryRun = dryRun
         self.preserveNames = preserveNames
         self.ignoreAlbums = ignoreAlbums
-        self.existingFilenamesMap = {}
-        self.whatsappImagePaths = {}
+        self.probeDates = probeDates
+        self.probePool = None
+        self.mediaDates = None     #fileID -> (blobCrc, date), see ExtractionJournal.mediaDates()
+        self.existingFilenames = None
+        self.dirNames = DirNames()
+        self.whatsappImagePaths = PathMap()   #Media path in ChatStorage.sqlite -> CompactPath of the linked file
         self.whatsappThumbnailPath = ""
         self.whatsappStickersPath = ""
         self.whatsappDocumentsByGuid = {}
-        self.albumByPictureName = None
+        self.albumIndex = None
+        self.photoAssets = None
+        self.databases = SourceDatabases()
+        self.archive = None
+        if archiveFile != None:
+            #The archive is written again on every run, so every file is processed. It is written
+            #one file at a time, the jobs compress it:
+            full = True
+            if not dryRun:
+                self.archive = ArchiveSink(archiveFile, out_dir, jobs)
+            jobs = 1
+        self.linker = LinkExecutor(jobs)
+        self.closed = False
+        self.linkStrategy = linkStrategy
+        self.contentIndex = ContentIndex(dedupIndex) if dedupIndex != None and not self.dryRun else None
+        self.fs = FsSnapshot(backup_dir, out_dir, fsCache)
+        self.profiler = StageProfiler(profileDir) if profileDir != None else None
+        self.progress = Progress(profiler=self.profiler)
+        self.decodePool = ProcessPoolExecutor(max_workers=procs) if procs > 1 else None
+        self.since = since        #Unix timestamp, older files and chats are not extracted
+        self.olderSkipped = 0
+        self.unchangedSkipped = 0
+        self.useManifestCache = manifestCache
+        self.manifestCache = None
+        self.plan = None
+        self.planCount = 0
+        if planFile != None:
+            #Plans list every file, so the journal of previous runs is not used:
+            self.dryRun = True
+            full = True
+            self.plan = open(planFile, 'w', encoding='utf-8')
+            header = {"iphoneMaticPlan": 1, "backupDir": os.path.abspath(backup_dir), "outDir": os.path.abspath(out_dir),
+                      "created": datetime.now().isoformat(), "naming": self.namingSettings()}
+            self.plan.write(json.dumps(header) + "\n")
+        #Without writeState (createLinks()) the journal and the index of the runs in out_dir are left as they are:
+        stateReadOnly = self.dryRun or archiveFile != None or not writeState
+        if not stateReadOnly and not os.path.isfile(os.path.join(out_dir, ExportIndex.FILENAME)):
+            #Out dir of a version without the export index: the files of previous runs are indexed too
+            full = True
+        self.journal = ExtractionJournal(out_dir, self.namingSettings(), full, stateReadOnly)
+        self.exportIndex = None
+        if not self.dryRun and writeState:
+            #Next to the archive, or in out_dir. Cleared when the journal starts over, as every file is linked again:
+            if archiveFile != None:
+                self.exportIndex = ExportIndex(archiveFile + ".index.sqlite", out_dir, True)
+            else:
+                self.exportIndex = ExportIndex(os.path.join(out_dir, ExportIndex.FILENAME), out_dir, len(self.journal.entries) == 0)
+        self.existingFilenames = FilenameAllocator(isReserved=self.journal.isReservedByOther)
+
+    def namingSettings(self):
+        #Options that change the output names. The journal is rebuilt if they change.
+        settings = "preserveNames={} ignoreAlbums={} cameraDates=Photos.sqlite/ZDATECREATED".format(self.preserveNames, self.ignoreAlbums)
+        if self.probeDates:
+            settings += " probeDates=True"
+        return settings
+
+    def close(self):
+        #Can be called more than once:
+        if self.closed:
+            return
+        self.closed = True
+        self.linker.shutdown()
+        if self.plan != None:
+            self.plan.close()
+            self.plan = None
+            console.summary("Plan written with {} files".format(self.planCount))
+        if self.archive != None:
+            self.archive.close()
+            console.summary("Archive written with {} files".format(self.archive.files))
+            self.archive = None
+        if self.decodePool != None:
+            self.decodePool.shutdown()
+            self.decodePool = None
+        if self.probePool != None:
+            self.probePool.shutdown()
+            self.probePool = None
+        if self.contentIndex != None:
+            self.contentIndex.close()
+        if self.exportIndex != None:
+            self.exportIndex.close()
+            self.exportIndex = None
+        self.journal.close()
+        self.databases.close()
+        if self.manifestCache != None:
+            self.manifestCache.close()
+            self.manifestCache = None
+        if self.profiler != None:
+            self.profiler.writeReport()
+            self.profiler = None
+
+    def stage(self, name):
+        #Profiles the parts of the run that are not phases of their own:
+        return self.profiler.stage(name) if self.profiler != None else nullcontext()
+
+
+    def resolveOutputFile(self, relPath, domain=None, relativePath=None):
+        #Returns the file in out_dir, or the backup file that would be linked there if it
+        #wasn't linked yet (--pretend, --plan). If this run didn't link it (its category
+        #was skipped), the backup file is looked up in Manifest.db, as out_dir may be stale.
+        path = os.path.join(self.out_dir, relPath)
+        source = self.existingFilenames.taken.get(os.path.abspath(path))
+        if source != None:
+            source = os.path.join(self.backup_dir, source[:2], source)   #The fileID is kept
+        if source != None and os.path.isfile(path):
+            return path
+        if source == None and domain != None:
+            source = self.findBackupFile(domain, relativePath)
+        if source != None and os.path.isfile(source):
+            return source
+        return path
+
+    def resolveExportFile(self, database):
+        #The exports write to out_dir, so with --pretend they only read what is already there:
+        if self.dryRun:
+            return os.path.join(self.out_dir, database[0])
+        return self.resolveOutputFile(*database)
+
+    def findBackupFile(self, domain, relativePath):
+        manifestFilename = os.path.join(self.backup_dir, 'Manifest.db')
+        if not os.path.isfile(manifestFilename):
+            return None
+        conn = self.databases.connect(manifestFilename)
+        row = conn.execute("SELECT fileID FROM Files WHERE domain = ? AND relativePath = ?", (domain, relativePath)).fetchone()
+        if row == None:
+            return None
+        return os.path.abspath(os.path.join(self.backup_dir, row[0][:2], row[0]))
 
     def buildWhatsappDocumentsGuidTable(self):
 
-        whatsappDbFilename = os.path.join(self.out_dir, "FilesAppGroups/group.net.whatsapp.WhatsApp.shared/ChatStorage.sqlite")
+        whatsappDbFilename = self.resolveOutputFile(*WHATSAPP_CHATS_DB)
         if not os.path.isfile(whatsappDbFilename):
-            print(RED_COLOR + "ERROR: ChatStorage.sqlite not found. Whatsapp chats will not be exported" + NO_COLOR)
+            console.error("ERROR: ChatStorage.sqlite not found. Whatsapp chats will not be exported")
             return
 
-        conn = sqlite3.connect(whatsappDbFilename)
+        conn = self.databases.connect(whatsappDbFilename, "ChatStorage.sqlite")
         query = "SELECT i.ZFILESIZE, i.ZMEDIALOCALPATH, i.ZXMPPTHUMBPATH, i.ZAUTHORNAME " \
                 + "FROM ZWAMEDIAITEM i "
         r = conn.cursor().execute(query)
         for mediaFileSize, mediaLocalPath, mediaThumbnailLocalPath, docName in r:
-            doc = {"originalFilename": docName, "fileSize": mediaFileSize, \
-                   "localPath": mediaLocalPath, "thumbnailPath": mediaThumbnailLocalPath}
+            if docName == None and mediaThumbnailLocalPath == None:
+                continue    #Nothing to look up for it
             #Add to table:
-            self.whatsappDocumentsByGuid[mediaLocalPath] = doc
-
+            self.whatsappDocumentsByGuid[mediaLocalPath] = WhatsappDocument(docName, mediaThumbnailLocalPath)
 
 
-    def extractHardlinksWhatsapp(self, subdir, whatsappThumbnailSubdir, whatsappStickersSubdir, domainFilter, pathFilter, typeStr="TypeNormal"):
-        self.buildWhatsappDocumentsGuidTable()
-        self.whatsappThumbnailPath = os.path.join(self.out_dir, whatsappThumbnailSubdir)
-        self.whatsappStickersPath = os.path.join(self.out_dir, whatsappStickersSubdir)
-        self.extractHardlinks(subdir, domainFilter, pathFilter, "TypeWhatsapp")
-
 
-    def buildAlbumByPictureName(self):
-        if self.ignoreAlbums:
-            self.albumByPictureName = {}
+    def buildAlbumIndex(self):
+        #Albums, capture dates and original names of the camera pictures:
+        self.albumIndex = AlbumIndex()
+        self.photoAssets = PhotoAssets()
+        photoDataDb = os.path.join(self.backup_dir, '12/12b144c0bd44f2b3dffd9186d3f9c05b917cee25')
+        if not os.path.isfile(photoDataDb):
+            if self.ignoreAlbums:
+                console.warning("WARNING: Photos.sqlite not found. Pictures will be named by the date of their file")
+            else:
+                console.warning("WARNING: Photos.sqlite not found. Pictures will not be placed in album subfolders " \
+                                + "and will be named by the date of their file")
             return
+        conn = self.databases.connect(photoDataDb, "Photos.sqlite")
+        self.photoAssets.load(conn)
+        if not self.ignoreAlbums:
+            self.albumIndex.load(conn)
 
-        photoDataDb = os.path.join(self.backup_dir, '12/12b144c0bd44f2b3dffd9186d3f9c05b917cee25')
 
-        conn = sqlite3.connect(photoDataDb)
+    def queryRows(self, domainFilter, pathFilter):
+        conn = self.databases.connect(os.path.join(self.backup_dir, 'Manifest.db'))
 
+        # simple query to get only media (without thumbnails)
+        query = "SELECT fileId, domain, relativePath, flags, file FROM Files " \
+                + "WHERE domain LIKE :domainFilter AND relativePath LIKE :pathFilter " \
+                + "ORDER BY relativePath"
+        return conn.cursor().execute(query, {"domainFilter": domainFilter, "pathFilter": pathFilter})
+
+
+    def planLinks(self, rules=None):
+        #Generator of the LinkRecords of the rules (all of them by default), in the order and with
+        #the names of a fresh extraction: the journal of previous runs in out_dir is ignored, so no
+        #file is skipped and no name is reserved. Nothing is created: the records can go to linkRecords()
+        #or to any other consumer. Manifest.db is read one rule at a time, keeping only a batch of rows.
+        journal, existingFilenames = self.journal, self.existingFilenames
+        #Read-only, only its dates of --probe-dates are used:
+        self.journal = ExtractionJournal(self.out_dir, self.namingSettings(), True, True)
+        self.existingFilenames = FilenameAllocator()
+        try:
+            for rule in rules if rules != None else EXTRACT_RULES:
+                self.prepareRule(rule)
+                for record, reportFile, journalEntry, replaceStale in self.planRows(rule.subdir, self.queryRows(rule.domainFilter, rule.pathFilter), rule.typeStr):
+                    yield record
+        finally:
+            self.journal.close()
+            self.journal, self.existingFilenames = journal, existingFilenames
+
+
+    def linkRecords(self, records):
+        #Creates the links of a stream of LinkRecords (eg: from planLinks()) with the threads and the
+        #link strategy of this instance. Returns the number of records.
+        count = 0
+        for record in records:
+            self.linker.submit(self.linkFile, record, record.dest)
+            count += 1
+        self.linker.wait()
+        return count
+
+
+    def extractRules(self, rules):
+        #Reads Manifest.db once and routes every row to the rules that match it. Produces
+        #the same links as calling extractRule() once per rule, in the same order.
+        #The filters of the rules are pushed into the query, so rows of skipped categories
+        #aren't read at all.
+        if len(rules) == 0:
+            return
+        rowsByRule = [[] for rule in rules]
+        total = 0
+        with self.stage("ManifestScan"):
+            cache = self.loadManifestCache(rules)
+            if cache != None:
+                rows = cache.rows(lambda domain: domain != None and any(rule.domainRegex.fullmatch(domain) for rule in rules))
+            else:
+                conn = self.databases.connect(os.path.join(self.backup_dir, 'Manifest.db'))
+                query = "SELECT fileId, domain, relativePath, flags, file FROM Files WHERE " \
+                        + " OR ".join(["(domain LIKE ? AND relativePath LIKE ?)"] * len(rules))
+                params = []
+                for rule in rules:
+                    params += [rule.domainFilter, rule.pathFilter]
+                rows = conn.cursor().execute(query, params)
+            for row in rows:
+                matched = False
+                for rule, ruleRows in zip(rules, rowsByRule):
+                    if rule.matches(row[1], row[2]):
+                        ruleRows.append(row)
+                        matched = True
+                total += matched
+
+        console.info("Manifest.db rows read: {}{}".format(total, " (from the manifest cache)" if cache != None else ""))
+        for rule, rows in zip(rules, rowsByRule):
+            console.info("    {}: {}".format(rule.subdir, len(rows)))
+
+        for rule, rows in zip(rules, rowsByRule):
+            #Stable sort, so equal relativePaths keep the Manifest.db order like ORDER BY does:
+            rows.sort(key=lambda row: row[2])
+            self.extractRule(rule, rows)
+            rows.clear()
+
+
+    def loadManifestCache(self, rules=None):
+        #Returns the ManifestCache of this Manifest.db, building it if needed, or None.
+        #--pretend, --plan and --archive only use it if it's already there, as they don't write to out_dir.
+        #Neither do runs of only some of the rules: the rows of the other categories aren't read.
+        if not self.useManifestCache:
+            return None
+        if self.manifestCache != None:
+            return self.manifestCache
+        manifestFilename = os.path.join(self.backup_dir, 'Manifest.db')
+        if not os.path.isfile(manifestFilename):
+            return None
+        cache = ManifestCache(self.out_dir)
+        signature = ManifestCache.signature(manifestFilename)
+        if cache.load(signature):
+            self.manifestCache = cache
+        elif not self.dryRun and self.archive == None and (rules == None or all(rule in rules for rule in EXTRACT_RULES)):
+            previous = ManifestCache(self.out_dir)
+            if not previous.load(None):
+                previous = None
+            try:
+                if cache.build(self.databases.connect(manifestFilename), self.decodeBlobs, signature, previous):
+                    self.manifestCache = cache
+                    console.info("Manifest cache updated: {} of {} rows decoded".format(cache.decodedCount, cache.count))
+            except (OSError, ValueError, sqlite3.Error) as e:
+                console.warning("WARNING: Could not write the manifest cache: {}".format(e))
+            finally:
+                if previous != None:
+                    previous.close()
+        return self.manifestCache
+
+
+    def extractRule(self, rule, rows=None):
+        #If rows is None, Manifest.db is queried for this rule only.
+        if rule.banner != None:
+            console.banner(rule.banner)
+        self.prepareRule(rule)
+        if rows == None:
+            conn = self.databases.connect(os.path.join(self.backup_dir, 'Manifest.db'))
+            countQuery = "SELECT COUNT(*) FROM Files WHERE domain LIKE :domainFilter AND relativePath LIKE :pathFilter"
+            total = conn.cursor().execute(countQuery, {"domainFilter": rule.domainFilter, "pathFilter": rule.pathFilter}).fetchone()[0]
+            self.processRows(rule.subdir, self.queryRows(rule.domainFilter, rule.pathFilter), rule.typeStr, total)
+        else:
+            self.processRows(rule.subdir, rows, rule.typeStr, len(rows))
 
-        albumNamesById = {}
-        query = "SELECT album.ZTITLE, album.Z_PK AS albumId, album.ZPARENTFOLDER AS paretFolder " \
-                + "FROM ZGENERICALBUM album " \
-                + "ORDER BY album.ZTITLE"
-        r = conn.cursor().execute(query)
-        #First pass:
-        for albumTitle, albumId, parentFolderId in r:
-            albumNamesById[albumId] = {"title": albumTitle if albumTitle != None else "(noname)", \
-                                       "parentId": parentFolderId}
-        #Gather parent folders:
-        albumPathsById = {}
-        r = conn.cursor().execute(query)
-        for albumTitle, albumId, parentFolderId in r:
-            albumPath = albumTitle if albumTitle != None else "(noname)"
-            if albumId in albumNamesById:
-                current = albumNamesById[albumId]
-                while current["parentId"] != None:
-                    if current["parentId"] in albumNamesById:
-                        current = albumNamesById[current["parentId"]]
-                        if current["parentId"] != None:  #Don't add root dir as "(noname)"
-                            albumPath = os.path.join(current["title"], albumPath)
-            albumPathsById[albumId] = albumPath
-
-
-        query = "SELECT album.ZTITLE, album.Z_PK AS albumId, za.ZDIRECTORY, za.ZFILENAME " \
-                + "FROM Z_33ASSETS aa " \
-                + "INNER JOIN ZGENERICALBUM album ON album.Z_PK = aa.Z_33ALBUMS " \
-                + "INNER JOIN ZASSET za ON za.Z_PK = aa.Z_3ASSETS " \
-                + "ORDER BY album.ZTITLE"
 
-        self.albumByPictureName = {}
+    def prepareRule(self, rule):
+        if rule.typeStr == "TypeWhatsapp":
+            self.buildWhatsappDocumentsGuidTable()
+            self.whatsappThumbnailPath = os.path.join(self.out_dir, rule.thumbnailSubdir)
+            self.whatsappStickersPath = os.path.join(self.out_dir, rule.stickersSubdir)
 
-        r = conn.cursor().execute(query)
-        for albumTitle, albumId, imageDirectory, imageFilename in r:
-            dirAndFilename = imageDirectory + "/" + imageFilename
-            if albumId in albumPathsById:
-                albumPath = albumPathsById[albumId]
-            else:
-                albumPath = albumTitle
-            self.albumByPictureName[dirAndFilename] = albumPath
-            #print(albumTitle, " : ", dirAndFilename)
 
+    def processRows(self, subdir, rows, typeStr, total=None):
+        with self.progress.phase(subdir, total):
+            self.processPhaseRows(subdir, rows, typeStr)
 
-    def extractHardlinks(self, subdir, domainFilter, pathFilter, typeStr="TypeNormal"):
 
-        if self.albumByPictureName == None and typeStr == "TypePhotos":
-            self.buildAlbumByPictureName()
+    def processPhaseRows(self, subdir, rows, typeStr):
+        #Naming is done by planRows(), here the links are created (or written to the plan):
+        for planned in self.planRows(subdir, rows, typeStr):
+            self.submitLink(*planned)
+            self.journal.flush()
+        #Later stages read files linked here (eg: ChatStorage.sqlite):
+        self.linker.wait()
+        self.journal.flush(force=True)
+        if self.unchangedSkipped > 0:
+            console.info("{}: {} unchanged files skipped".format(subdir, self.unchangedSkipped))
+            self.unchangedSkipped = 0
+        if self.olderSkipped > 0:
+            console.info("{}: {} files older than --since skipped".format(subdir, self.olderSkipped))
+            self.olderSkipped = 0
 
-        conn = sqlite3.connect(os.path.join(self.backup_dir, 'Manifest.db'))
 
-        # simple query to get only media (without thumbnails)
-        query = "SELECT fileId, domain, relativePath, flags, file FROM Files " \
-                + "WHERE domain LIKE :domainFilter AND relativePath LIKE :pathFilter " \
-                + "ORDER BY relativePath"
+    def planRows(self, subdir, rows, typeStr):
+        #Generator of the links of Manifest.db rows, as (LinkRecord, reportFile, journalEntry, replaceStale).
+        #Names are taken as the rows are read, so the links must be consumed in order. Only
+        #DECODE_BATCH rows are held at a time.
+        if self.albumIndex == None and typeStr == "TypePhotos":
+            with self.stage("PhotosIndex"):
+                self.buildAlbumIndex()
 
         MAX = -1
         i = 0
-        r = conn.cursor().execute(query, {"domainFilter": domainFilter, "pathFilter": pathFilter})
-        for subfile, domain, relpath, _, blob in r:
+        batch = []
+        for subfile, domain, relpath, _, blob in rows:
+            self.progress.advance()
+            origin = (domain, relpath)   #Row of Manifest.db, for the export index
             # files are stored in subdirectories, that match first 2 characters of their names
             sourceSubdir = subfile[:2]
 
@@ -234,13 +2044,12 @@ class IPhoneMatic:
             if typeStr == "TypeWhatsapp":
                 originalWhatsappFilename = removePrefix(originalWhatsappFilename, "Message/")
 
-            #Fetch album:
-            albumPath = None
+            #Fetch albums. Pictures in several albums are linked in each one:
+            albumPaths = (None,)
+            photoPath = None
             if typeStr == "TypePhotos":
-                imagePathKey = removePrefix(relpath, "Media/")
-                if imagePathKey in self.albumByPictureName:
-                    albumPath = self.albumByPictureName[imagePathKey]
-                    #print("Found album: ", albumPath, "for", relpath)
+                photoPath = removePrefix(relpath, "Media/")
+                albumPaths = self.albumIndex.albumsOf(photoPath) or albumPaths
 
             relpath = removePrefix(relpath, "Media/DCIM/")
             relpath = removePrefix(relpath, "100APPLE/")
@@ -278,64 +2087,139 @@ class IPhoneMatic:
                 outputDir = os.path.join(outputDir, self.whatsappStickersPath)
             if subdir != "" and subdir != None and not useThumbnailDir and not useStickersDir:
                 outputDir = os.path.join(outputDir, subdir)
-            if albumPath != None:
-                outputDir = os.path.join(outputDir, albumPath)
-            destFile = os.path.abspath(os.path.join(outputDir, relpath))
-
-            if os.path.isfile(sourceFile):
-                try:
-                    self.processFile(sourceFile, destFile, blob, typeStr, originalWhatsappFilename)
-                except Exception as e:
-                    print("ERROR processing file", destFile, ": ", e, '\n')
-                    print(e)
-                i += 1
+            if isinstance(blob, DecodedBlob):
+                blobCrc = blob.crc
+            else:
+                blobCrc = zlib.crc32(blob) if blob != None else 0
+
+            for albumIndex, albumPath in enumerate(albumPaths):
+                #The extra albums of a picture are journaled as rows of their own:
+                journalKey = (subfile, subdir) if albumIndex == 0 else (subfile + "/" + albumPath, subdir)
+
+                #Skip files that didn't change since the last run, but keep their names taken:
+                unchangedDestFile, previousDestFile = self.journal.lookup(journalKey, blobCrc)
+                if unchangedDestFile != None and unchangedDestFile not in self.existingFilenames:
+                    self.existingFilenames.add(unchangedDestFile, subfile)
+                    if typeStr == "TypeWhatsapp":
+                        self.whatsappImagePaths[originalWhatsappFilename] = self.dirNames.compact(unchangedDestFile)
+                    self.unchangedSkipped += 1
+                    continue
+
+                destFile = os.path.abspath(os.path.join(outputDir, albumPath, relpath) if albumPath != None \
+                                           else os.path.join(outputDir, relpath))
+
+                if self.fs.sourceExists(sourceFile):
+                    if photoPath != None:
+                        #Named from Photos.sqlite, only the Size is read from the blob (once, and not for unchanged rows):
+                        if isinstance(blob, DecodedBlob):
+                            fileSize = blob.decoded[1]
+                        else:
+                            fileSize = decodeFileSize(blob) if blob != None else None
+                        photoDecoded = self.photoAssets.decodedOf(photoPath, fileSize)
+                        if photoDecoded != None:
+                            blob = DecodedBlob(photoDecoded, blobCrc)
+                        photoPath = None
+                    batch.append((sourceFile, destFile, blob, originalWhatsappFilename, journalKey, blobCrc, previousDestFile, albumPath, origin))
+                    if len(batch) >= self.DECODE_BATCH:
+                        yield from self.planBatch(batch, typeStr, subdir)
+                        batch = []
+                    i += 1
 
             if MAX != -1 and i == MAX:
-                return
-
-
-    def processFile(self, sourceFile, destFile, blob, typeStr, originalWhatsappFilename):
-        lastModified = None
-        fileSize = None
-        parsed = {}
-        try:
-            reader = BPListReader(blob)
-            parsed = reader.parse()
-            #print(parsed)
-        except Exception as e:
-            print("Error reading: ", destFile, " with GUID ", os.path.basename(sourceFile))
-
-        if "$objects" in parsed and len(parsed["$objects"]) >= 2:
-            if "LastModified" in parsed["$objects"][1]:
-                lastModified = parsed["$objects"][1]["LastModified"]
-            if "Size" in parsed["$objects"][1]:
-                fileSize = parsed["$objects"][1]["Size"]
-            #print(lastModified)
-            #print(fileSize)
-            #print(parsed)
+                break
+
+        yield from self.planBatch(batch, typeStr, subdir)
+
+
+    def decodeBlobs(self, blobs):
+        if self.decodePool == None:
+            return [decodeFileBlob(blob) for blob in blobs]
+        #map() returns the results in order, so the naming stays deterministic:
+        chunks = [blobs[k : k + self.DECODE_CHUNK] for k in range(0, len(blobs), self.DECODE_CHUNK)]
+        decoded = []
+        for result in self.decodePool.map(decodeFileBlobs, chunks):
+            decoded.extend(result)
+        return decoded
+
+
+    def planBatch(self, batch, typeStr, subdir=None):
+        #Rows from the manifest cache or from Photos.sqlite are already decoded:
+        blobs = [item[2] for item in batch]
+        decodedBlobs = iter(self.decodeBlobs([blob for blob in blobs if not isinstance(blob, DecodedBlob)]))
+        decodedList = [blob.decoded if isinstance(blob, DecodedBlob) else next(decodedBlobs) for blob in blobs]
+        probedDates = self.probeBatch(batch, subdir)
+        for item, decoded, probedDate in zip(batch, decodedList, probedDates):
+            sourceFile, destFile, _, originalWhatsappFilename, journalKey, blobCrc, previousDestFile, albumPath, origin = item
+            try:
+                planned = self.planFile(sourceFile, destFile, decoded, typeStr, originalWhatsappFilename,
+                                        journalKey, blobCrc, previousDestFile, albumPath, probedDate, origin)
+            except Exception as e:
+                console.error(fileErrorMessage(destFile, e))
+                self.progress.error()
+                continue
+            if planned != None:
+                yield planned
+
+
+    def probeBatch(self, batch, subdir):
+        #With --probe-dates, the dates that photos and videos of app files (PROBE_CATEGORIES) have inside
+        #(see mediaprobe.py), in the order of the batch. None for the other files. Results are kept in the
+        #journal by fileID, so files are only read again when they change.
+        if not self.probeDates or subdir not in PROBE_CATEGORIES:
+            return [None] * len(batch)
+        if self.mediaDates == None:
+            self.mediaDates = self.journal.mediaDates()
+        dates = [None] * len(batch)
+        toProbe = []
+        for k, item in enumerate(batch):
+            sourceFile, destFile, journalKey, blobCrc = item[0], item[1], item[4], item[5]
+            if os.path.splitext(destFile)[1].lower() not in mediaprobe.PROBE_EXTENSIONS:
+                continue
+            cached = self.mediaDates.get(journalKey[0])
+            if cached != None and cached[0] == blobCrc:
+                dates[k] = cached[1]
+            else:
+                toProbe.append(k)
+        if len(toProbe) > 0:
+            if self.probePool == None:
+                self.probePool = ThreadPoolExecutor(max_workers=self.PROBE_THREADS)
+            #map() returns the results in order, so the naming stays deterministic:
+            probed = list(self.probePool.map(mediaprobe.probeDate, [batch[k][0] for k in toProbe]))
+            newDates = []
+            for k, date in zip(toProbe, probed):
+                dates[k] = date
+                fileID, blobCrc = batch[k][4][0], batch[k][5]
+                self.mediaDates[fileID] = (blobCrc, date)
+                newDates.append((fileID, blobCrc, date))
+            self.journal.recordMediaDates(newDates)
+        return dates
+
+
+    def planFile(self, sourceFile, destFile, decoded, typeStr, originalWhatsappFilename,
+                 journalKey=None, blobCrc=0, previousDestFile=None, albumPath=None, probedDate=None, origin=(None, None)):
+        #Names one file. Returns (LinkRecord, reportFile, journalEntry, replaceStale), or None if
+        #it isn't linked.
+        reportFile = destFile
+        lastModified, fileSize, originalFilename, parseError, error = decoded
+        if parseError:
+            console.error("Error reading: {} with GUID {}".format(destFile, os.path.basename(sourceFile)))
+        if error != None:
+            raise Exception(error)
+        if probedDate != None:
+            #Date the photo or video was taken, read from the file with --probe-dates:
+            lastModified = probedDate
 
         if lastModified == None or fileSize == None:
-            print("Error reading, LastModified or Size attributes not found: ", destFile, " with GUID ", os.path.basename(sourceFile))
+            console.error("Error reading, LastModified or Size attributes not found: {} with GUID {}".format(destFile, os.path.basename(sourceFile)))
 
-        originalFilename = None
-        if "$objects" in parsed and len(parsed["$objects"]) >= 4:
-            blobInside = parsed["$objects"][3]
-            parsedInside = None
-            try:
-                readerInside = BPListReader(blobInside)
-                parsedInside = readerInside.parse()
-                #print(parsedInside)
-            except Exception as e:
-                #print("File '", destFile, "' error in originalFilename attributes: ", e)
-                pass
-            if parsedInside != None and "com.apple.assetsd.originalFilename" in parsedInside:
-                originalFilename = parsedInside["com.apple.assetsd.originalFilename"]
-                originalFilename = originalFilename.decode("utf-8")   #It comes as a binary string.
+        if originalFilename != None:
+            originalFilename = originalFilename.decode("utf-8")   #It comes as a binary string.
+        metadataFilename = originalFilename
 
         if originalFilename != None and (isFilename_IMG_NNNN(originalFilename) or isFilename_Guid(originalFilename)):
             originalFilename = None
 
-        if not self.preserveNames and typeStr != "TypeApp":
+        if not self.preserveNames and (typeStr != "TypeApp" or probedDate != None):
             if originalFilename != None:
                 p = pathlib.Path(destFile)
                 destDir = str(p.parent)
@@ -348,7 +2232,7 @@ class IPhoneMatic:
                 if typeStr == "TypeWhatsapp" and originalWhatsappFilename in self.whatsappDocumentsByGuid:
                     #Find the real filename of .PDF and .EPUB files and other docs:
                     f = self.whatsappDocumentsByGuid[originalWhatsappFilename]
-                    docFilename = f["originalFilename"]
+                    docFilename = f.originalFilename
                     if docFilename != None:
                         #Get only name and extension:
                         p = pathlib.Path(docFilename)
@@ -371,7 +2255,7 @@ class IPhoneMatic:
                     name = p.stem
                     destDir = str(p.parent)
 
-                    if name.startswith("IMG_") or typeStr == "TypeWhatsapp":
+                    if name.startswith("IMG_") or typeStr == "TypeWhatsapp" or probedDate != None:
                         name = "IMG_" + suffix
 
                     #Replace IMG_ with VID_ in videos:
@@ -387,41 +2271,138 @@ class IPhoneMatic:
                     destFile = os.path.join(destDir, newFilename)
 
         #Add _1 or _2 to filenames that have the same lastModified in seconds or the same originalFilename
-        if destFile in self.existingFilenamesMap:
-            p = pathlib.Path(destFile)
-            extension = p.suffix
-            name = p.stem
-            destDir = str(p.parent)
-            #Retry while the destFile already exists:
-            n = 1
-            while destFile in self.existingFilenamesMap:
-                destFile = os.path.join(destDir, name + "_" + str(n) + extension)
-                n += 1
-        self.existingFilenamesMap[destFile] = sourceFile
+        destFile = self.existingFilenames.allocate(destFile, os.path.basename(sourceFile), owner=journalKey)
 
         #Add to whatsapp images map:
+        whatsappKey = None
         if typeStr == "TypeWhatsapp":
-            self.whatsappImagePaths[originalWhatsappFilename] = destFile
-
-        if not os.path.isfile(destFile):
-            #Show source and dest:
-            print(sourceFile, "->", destFile)
-            if self.dryRun:
-                return
+            whatsappKey = originalWhatsappFilename
+            self.whatsappImagePaths[originalWhatsappFilename] = self.dirNames.compact(destFile)
+
+        #Older files keep their name taken (so names don't depend on --since), but aren't linked:
+        if self.since != None and lastModified != None and lastModified < self.since:
+            self.olderSkipped += 1
+            return None
+
+        record = LinkRecord(sourceFile, destFile, lastModified, fileSize,
+                            journalKey[1] if journalKey != None else None, albumPath, whatsappKey, metadataFilename, *origin)
+        journalEntry = None
+        if journalKey != None:
+            journalEntry = (journalKey, blobCrc)
+        #If the file changed since the last run and kept its name, the old link is stale:
+        replaceStale = previousDestFile != None and previousDestFile == destFile
+        return (record, reportFile, journalEntry, replaceStale)
+
+    def submitLink(self, record, reportFile=None, journalEntry=None, replaceStale=False):
+        if self.plan != None:
+            self.plan.write(json.dumps(record.toJson(self.backup_dir, self.out_dir)) + "\n")
+            self.planCount += 1
+            return
+        self.linker.submit(self.linkFile, record, reportFile if reportFile != None else record.dest, journalEntry, replaceStale)
+
+    def applyPlan(self, planFilename, categories=None):
+        #Links the files of a plan written with --plan, without reading Manifest.db.
+        #categories (subdirs of the rules) and --since select part of the plan.
+        with open(planFilename, 'r', encoding='utf-8') as file:
+            header = json.loads(file.readline())
+            if header.get("iphoneMaticPlan") != 1:
+                raise Exception("Not an iphoneMatic plan: " + planFilename)
+            records = (LinkRecord.fromJson(json.loads(line), self.backup_dir, self.out_dir) \
+                       for line in file if line.strip() != "")
+            for category, group in itertools.groupby(records, key=lambda record: record.category):
+                with self.progress.phase(category):
+                    for record in group:
+                        self.progress.advance()
+                        self.existingFilenames.add(record.dest, os.path.basename(record.source))
+                        if record.whatsappKey != None:
+                            self.whatsappImagePaths[record.whatsappKey] = self.dirNames.compact(record.dest)
+                        if categories != None and category not in categories:
+                            continue
+                        if self.since != None and record.mtime != None and record.mtime < self.since:
+                            continue
+                        self.linker.submit(self.linkFile, record, record.dest)
+                    self.linker.wait()
+        #Needed by the chats export:
+        self.buildWhatsappDocumentsGuidTable()
 
-            dirName = os.path.dirname(destFile)
-            #Create intermediate dirs:
-            if not os.path.exists(dirName):
-                ensureDirs(dirName)
-            #Hardlink:
+    def linkDeduplicated(self, record):
+        #Links the same content from a previous snapshot if there is one:
+        indexedFile, fastHash, fullHash = self.contentIndex.findIdentical(record.source, record.size, record.mtime)
+        deduplicated = False
+        if indexedFile != None:
             try:
-                os.link(sourceFile, destFile)
+                os.link(indexedFile, record.dest)
+                deduplicated = True
             except FileExistsError:
-                print("File exists")
-                pass
-            #Set MTIME:
-            if lastModified != None:
-                os.utime(destFile, (lastModified, lastModified))
+                raise
+            except OSError:
+                pass    #Eg: the previous snapshot is in another disk
+        if not deduplicated:
+            createLink(record.source, record.dest, self.linkStrategy)
+        self.contentIndex.add(os.path.abspath(record.dest), record.size, record.mtime, fastHash, fullHash, deduplicated)
+
+    def linkFile(self, record, reportFile, journalEntry=None, replaceStale=False):
+        #Filesystem part of a planned link, may run in a worker thread.
+        sourceFile = record.source
+        destFile = record.dest
+        lastModified = record.mtime
+        try:
+            if self.archive != None:
+                console.file(sourceFile + " -> " + destFile, "link", source=sourceFile, dest=destFile)
+                self.archive.addFile(sourceFile, destFile, lastModified)
+                self.progress.addBytes(record.size)
+                self.exportIndex.add(record)
+                return
+            if replaceStale and not self.dryRun and self.fs.destIsFile(destFile):
+                os.remove(destFile)
+                self.fs.removedFile(destFile)
+            if not self.fs.destIsFile(destFile):
+                #Show source and dest:
+                console.file(sourceFile + " -> " + destFile, "link", source=sourceFile, dest=destFile)
+                if self.dryRun:
+                    return
+
+                dirName = os.path.dirname(destFile)
+                #Create intermediate dirs:
+                if not self.fs.destDirExists(dirName):
+                    ensureDirs(dirName)
+                    self.fs.addedDir(dirName)
+                #Hardlink (or reflink or copy):
+                try:
+                    if self.contentIndex != None:
+                        self.linkDeduplicated(record)
+                    else:
+                        createLink(sourceFile, destFile, self.linkStrategy)
+                except FileExistsError:
+                    console.warning("File exists: " + destFile)
+                self.fs.addedFile(destFile)
+                self.progress.addBytes(record.size)
+                #Set MTIME:
+                if lastModified != None:
+                    os.utime(destFile, (lastModified, lastModified))
+            if journalEntry != None:
+                key, blobCrc = journalEntry
+                self.journal.record(key, blobCrc, lastModified, record.size, destFile, record.whatsappKey)
+            if self.exportIndex != None:
+                self.exportIndex.add(record)
+        except Exception as e:
+            console.error(fileErrorMessage(reportFile, e))
+            self.progress.error()
+
+    def writeOutput(self, filename, content):
+        #Files exported from the databases (chats, contacts) go to the archive if there is one:
+        if self.archive == None:
+            writeToFile(filename, content)
+            return
+        console.file("Writing to " + filename, "write", file=filename)
+        try:
+            self.archive.addData(filename, content)
+        except Exception as e:
+            console.error("Error writing file: " + filename + ": " + str(e))
+
+    def makeOutputDir(self, dirName):
+        if self.archive == None:
+            ensureDirs(dirName)
 
     def resolveLabel(self, label, phoneTypes):
         if label != None and label >= 0 and label < len(phoneTypes):
@@ -438,7 +2419,7 @@ class IPhoneMatic:
 
 
     def extractContactsVCF(self, contactsDbFilename, vcfFilename):
-        conn = sqlite3.connect(contactsDbFilename)
+        conn = self.databases.connect(contactsDbFilename, "AddressBook.sqlitedb")
 
         query = "SELECT value FROM ABMultiValueLabel label"
         phoneTypes = []
@@ -507,7 +2488,7 @@ class IPhoneMatic:
                 vcf += "BDAY:" + escapeForVcf(person["birthday"]) + "\n"
             vcf += "END:VCARD\n"
         #print(vcf)
-        writeToFile(vcfFilename, vcf)
+        self.writeOutput(vcfFilename, vcf)
 
 
     def extractWhatsappChatsFromDb(self, whatsappDbFilename, whatsappContactsDbFilename, chatsDir, chatsDirHtml):
@@ -525,7 +2506,7 @@ class IPhoneMatic:
         contactsByLId = {}
         contactsByJId = {}
         if os.path.isfile(whatsappContactsDbFilename):
-            conn = sqlite3.connect(whatsappContactsDbFilename)
+            conn = self.databases.connect(whatsappContactsDbFilename, "ContactsV2.sqlite")
 
             query = "SELECT Z_PK, ZFULLNAME, ZBUSINESSNAME, ZPHONENUMBER, ZLID, ZWHATSAPPID " \
                     + "FROM ZWAADDRESSBOOKCONTACT;"
@@ -542,9 +2523,13 @@ class IPhoneMatic:
 
 
         #Assign filename for chat, don't overwrite if they are called the same. Sort by Id.
-        existingChatFilenames = {}
+        existingChatFilenames = FilenameAllocator()
+
+        conn = self.databases.connect(whatsappDbFilename, "ChatStorage.sqlite")
+        olderSkipped = 0
 
-        conn = sqlite3.connect(whatsappDbFilename)
+        query = "SELECT COUNT(*) FROM ZWACHATSESSION c WHERE c.ZLASTMESSAGEDATE NOT NULL"
+        self.progress.setTotal(conn.cursor().execute(query).fetchone()[0])
 
         query = "SELECT c.ZPARTNERNAME, c.ZLASTMESSAGEDATE, c.ZCONTACTIDENTIFIER AS chat_lid, ZCONTACTJID AS chat_jid " \
                 + "FROM ZWACHATSESSION c " \
@@ -552,6 +2537,23 @@ class IPhoneMatic:
                 + "ORDER BY c.Z_PK ASC"
 
         for chatName, lastMessageDate, chatLid, chatJid in conn.cursor().execute(query):
+            self.progress.advance()
+
+            if chatName == "":
+                chatName = "(empty)"
+            chatFilename = os.path.join(chatsDir, fixFilenameWithPlus(chatName + ".txt"))
+            chatFilenameHtml = os.path.join(chatsDirHtml, fixFilenameWithPlus(chatName + ".html"))
+
+            #Add _1 or _2 to filenames that have the same name:
+            uniqueChatFilename = existingChatFilenames.allocate(chatFilename, dirName=chatsDir)
+            if uniqueChatFilename != chatFilename:
+                chatFilename = uniqueChatFilename
+                chatFilenameHtml = os.path.join(chatsDirHtml, pathlib.Path(chatFilename).stem + ".html")
+
+            #Chats without new messages keep their name taken, but their messages aren't read:
+            if self.since != None and float(lastMessageDate) + 978307200 < self.since:
+                olderSkipped += 1
+                continue
 
             query = "SELECT c.ZPARTNERNAME, t.ZPARTNERNAME, m.ZTEXT, m.ZMESSAGEDATE, m.ZCHATSESSION, m.ZGROUPMEMBER, " \
                     + "g.ZMEMBERJID, m.ZMESSAGETYPE, " \
@@ -568,25 +2570,6 @@ class IPhoneMatic:
 
             r = conn.cursor().execute(query, {"chatJid": chatJid})
 
-            if chatName == "":
-                chatName = "(empty)"
-            chatFilename = os.path.join(chatsDir, fixFilenameWithPlus(chatName + ".txt"))
-            chatFilenameHtml = os.path.join(chatsDirHtml, fixFilenameWithPlus(chatName + ".html"))
-
-            #Add _1 or _2 to filenames that have the same name:
-            if chatFilename in existingChatFilenames:
-                p = pathlib.Path(chatFilename)
-                extension = p.suffix
-                name = p.stem
-                destDir = str(p.parent)
-                #Retry while the chatFilename already exists:
-                n = 1
-                while chatFilename in existingChatFilenames:
-                    chatFilename = os.path.join(chatsDir, name + "_" + str(n) + extension)
-                    chatFilenameHtml = os.path.join(chatsDirHtml, name + "_" + str(n) + ".html")
-                    n += 1
-            existingChatFilenames[chatFilename] = 1
-
             #Process messages:
             content = ""
             contentHtml = ""
@@ -639,7 +2622,7 @@ class IPhoneMatic:
                             thumbnailPath = None
                             if mediaLocalPath in self.whatsappDocumentsByGuid:
                                 doc = self.whatsappDocumentsByGuid[mediaLocalPath]
-                                thumbnailMediaLocalPath = doc["thumbnailPath"]
+                                thumbnailMediaLocalPath = doc.thumbnailPath
                                 if thumbnailMediaLocalPath != None and thumbnailMediaLocalPath in self.whatsappImagePaths:
                                     thumbnailPath = self.whatsappImagePaths[thumbnailMediaLocalPath]
                             #Relativize paths:
@@ -704,8 +2687,11 @@ class IPhoneMatic:
             contentHtml += "</pre></body></html>"
 
             #Write chat file:
-            writeToFile(chatFilename, content)
-            writeToFile(chatFilenameHtml, contentHtml)
+            self.writeOutput(chatFilename, content)
+            self.writeOutput(chatFilenameHtml, contentHtml)
+
+        if olderSkipped > 0:
+            console.info("WhatsappChats: {} chats without messages since --since skipped".format(olderSkipped))
 
 
 
@@ -722,53 +2708,418 @@ class IPhoneMatic:
 
 
     def exportNotes(self):
-        print(BLUE_COLOR + "Exporting notes..." + NO_COLOR)
+        with self.progress.phase('Notes'):
+            self.exportNotesPhase()
+
+    def exportNotesPhase(self):
+        console.banner("Exporting notes...")
         if not self.checkExportNotes():
-            print(RED_COLOR + "ERROR: You need to run 'pip install --break-system-packages bs4 pytz biplist' to be able to export Notes (or you can comment out exportNotes() at the bottom of this file)" + NO_COLOR)
+            console.error("ERROR: You need to run 'pip install --break-system-packages bs4 pytz biplist' to be able to export Notes (or you can comment out exportNotes() at the bottom of this file)")
             return
-        notesDbFilename = os.path.join(self.out_dir, "FilesAppGroups/group.com.apple.notes/NoteStore.sqlite")
+        notesDbFilename = self.resolveExportFile(NOTES_DB)
         if not os.path.isfile(notesDbFilename):
-            print("WARNING: NoteStore.sqlite not found. Notes will not be exported")
+            console.warning("WARNING: NoteStore.sqlite not found. Notes will not be exported")
             return
         destNotesDir = os.path.join(self.out_dir, "Notes")
+        if self.archive != None:
+            #readnotes writes to a directory, its files are moved to the archive afterwards:
+            notesDir = tempfile.mkdtemp(prefix="iphoneMatic_notes_")
+            try:
+                self.runReadnotes(notesDbFilename, notesDir)
+                for dirPath, dirNames, fileNames in os.walk(notesDir):
+                    dirNames.sort()
+                    for fileName in sorted(fileNames):
+                        filename = os.path.join(dirPath, fileName)
+                        with open(filename, 'rb') as file:
+                            self.archive.addData(os.path.join(destNotesDir, os.path.relpath(filename, notesDir)),
+                                                 file.read(), os.path.getmtime(filename))
+            finally:
+                shutil.rmtree(notesDir, ignore_errors=True)
+            return
         ensureDirs(destNotesDir)
-        os.system("python3 -B readnotes/readnotes.py  --user all --input \"" \
+        self.runReadnotes(notesDbFilename, destNotesDir)
+
+    def runReadnotes(self, notesDbFilename, destNotesDir):
+        notesOptions = ""
+        if self.since != None:
+            notesOptions = " --since " + str(self.since)
+        if not console.showFiles:
+            notesOptions += " --quiet"
+        profileOptions = ""
+        if self.profiler != None:
+            #readnotes runs in its own process, it gets its own profile:
+            profileOptions = " -m cProfile -o \"" + self.profiler.fileStem(len(self.profiler.stages), "Notes_readnotes") + ".pstats\""
+        os.system("python3 -B" + profileOptions + " readnotes/readnotes.py  --user all --input \"" \
                 + notesDbFilename \
-                + "\" --output \"" + destNotesDir + "\"")
+                + "\" --output \"" + destNotesDir + "\"" + notesOptions)
 
     def exportContacts(self):
-        print(BLUE_COLOR + "Exporting contacts..." + NO_COLOR)
-        contactsDbFilename = os.path.join(self.out_dir, "FilesHome/Library/AddressBook/AddressBook.sqlitedb")
+        with self.progress.phase('Contacts'):
+            self.exportContactsPhase()
+
+    def exportContactsPhase(self):
+        console.banner("Exporting contacts...")
+        contactsDbFilename = self.resolveExportFile(CONTACTS_DB)
         if not os.path.isfile(contactsDbFilename):
-            print(RED_COLOR + "WARNING: AddressBook.sqlite not found. Contacts will not be exported" + NO_COLOR)
+            console.warning("WARNING: AddressBook.sqlite not found. Contacts will not be exported")
             return
         vcfDir = os.path.join(self.out_dir, "Contacts")
-        ensureDirs(vcfDir)
+        self.makeOutputDir(vcfDir)
         suffixDate = datetime.fromtimestamp(os.path.getmtime(contactsDbFilename)).strftime("%Y-%m-%d")
         vcfFilename = os.path.join(vcfDir, "contacts_" + suffixDate + ".vcf")
         if (os.path.isfile(contactsDbFilename)):
+            self.progress.setTotal(1)
             self.extractContactsVCF(contactsDbFilename, vcfFilename)
+            self.progress.advance()
 
     def exportWhatsappChats(self):
-        print(BLUE_COLOR + "Exporting whatsapp chats..." + NO_COLOR)
-        whatsappContactsDbFilename = os.path.join(self.out_dir, "FilesAppGroups/group.net.whatsapp.WhatsApp.shared/ContactsV2.sqlite")
-        whatsappDbFilename = os.path.join(self.out_dir, "FilesAppGroups/group.net.whatsapp.WhatsApp.shared/ChatStorage.sqlite")
+        with self.progress.phase('WhatsappChats'):
+            self.exportWhatsappChatsPhase()
+
+    def exportWhatsappChatsPhase(self):
+        console.banner("Exporting whatsapp chats...")
+        whatsappContactsDbFilename = self.resolveExportFile(WHATSAPP_CONTACTS_DB)
+        whatsappDbFilename = self.resolveExportFile(WHATSAPP_CHATS_DB)
         if not os.path.isfile(whatsappDbFilename):
-            print(RED_COLOR + "ERROR: ChatStorage.sqlite not found. Whatsapp chats will not be exported" + NO_COLOR)
+            console.error("ERROR: ChatStorage.sqlite not found. Whatsapp chats will not be exported")
             return
+        if len(self.whatsappDocumentsByGuid) == 0:
+            #The Whatsapp category was skipped, use the media linked by previous runs:
+            self.buildWhatsappDocumentsGuidTable()
+            for whatsappKey, destFile in self.journal.whatsappPaths().items():
+                if whatsappKey not in self.whatsappImagePaths:
+                    self.whatsappImagePaths[whatsappKey] = self.dirNames.compact(destFile)
         if not os.path.isfile(whatsappContactsDbFilename):
-            print(RED_COLOR + "WARNING: ContactsV2.sqlite not found. Group member names will not be written" + NO_COLOR)
+            console.warning("WARNING: ContactsV2.sqlite not found. Group member names will not be written")
         chatsDir = os.path.join(self.out_dir, "WhatsappChats")
         chatsDirHtml = os.path.join(self.out_dir, "WhatsappChatsHtml")
-        ensureDirs(chatsDir)
-        ensureDirs(chatsDirHtml)
+        self.makeOutputDir(chatsDir)
+        self.makeOutputDir(chatsDirHtml)
         self.extractWhatsappChatsFromDb(whatsappDbFilename, whatsappContactsDbFilename, chatsDir, chatsDirHtml)
 
+    def reportStats(self, summaryJson=None):
+        self.progress.printSummary()
+        self.fs.report()
+        self.databases.report()
+        if self.contentIndex != None:
+            self.contentIndex.report()
+        if summaryJson != None:
+            self.progress.writeJson(summaryJson, {"backupDir": os.path.abspath(self.backup_dir),
+                                                  "outDir": os.path.abspath(self.out_dir),
+                                                  "fsChecks": self.fs.checks, "fsSyscalls": self.fs.syscalls,
+                                                  "databases": self.databases.stats,
+                                                  "deduplicatedFiles": self.contentIndex.hits if self.contentIndex != None else 0,
+                                                  "deduplicatedBytes": self.contentIndex.bytesSaved if self.contentIndex != None else 0})
+
+
+def iterLinks(backup_dir, out_dir, categories=None, preserveNames=False, ignoreAlbums=False, since=None, procs=1, probeDates=False):
+    #Use from Python: yields the LinkRecords that a run would create, as Manifest.db is read,
+    #without touching out_dir. categories are the subdirs of EXTRACT_RULES (all by default).
+    #    for record in iphoneMatic.iterLinks("Backup/00008110-001A18D40EFB801E", "Links/"):
+    #        print(record.source, record.dest, record.mtime)
+    matic = IPhoneMatic(backup_dir, out_dir, True, preserveNames, ignoreAlbums, full=True, procs=max(1, procs), since=since,
+                        probeDates=probeDates)
+    try:
+        yield from matic.planLinks([rule for rule in EXTRACT_RULES if categories == None or rule.subdir in categories])
+    finally:
+        matic.close()
+
+def createLinks(records, backup_dir, out_dir, jobs=1, linkStrategy="hardlink"):
+    #Creates the links of LinkRecords (eg: from iterLinks(), maybe filtered). Returns how many.
+    #The state journal and the export index of out_dir are not touched, so later runs of the
+    #command line work as before.
+    matic = IPhoneMatic(backup_dir, out_dir, False, False, False, jobs=max(1, jobs), linkStrategy=linkStrategy,
+                        writeState=False)
+    try:
+        return matic.linkRecords(records)
+    finally:
+        matic.close()
+
+
+def findBackups(backupRoot):
+    #Backup dirs are the ones with a Manifest.db, usually MobileSync/Backup/<UDID>:
+    backups = []
+    if os.path.isfile(os.path.join(backupRoot, "Manifest.db")):
+        backups.append(backupRoot)
+    for entry in sorted(os.scandir(backupRoot), key=lambda entry: entry.name):
+        if entry.is_dir() and os.path.isfile(os.path.join(entry.path, "Manifest.db")):
+            backups.append(entry.path)
+    return backups
+
+
+def runBatchDevice(backupDir, outRoot, extraArgs, diskSemaphore):
+    name = os.path.basename(os.path.normpath(backupDir))
+    outDir = os.path.join(outRoot, name)
+    summaryJson = os.path.join(outRoot, name + ".summary.json")
+    logFilename = os.path.join(outRoot, name + ".log")
+    command = [sys.executable, os.path.abspath(__file__), backupDir, outDir, "--summary-json", summaryJson] + extraArgs
+    with diskSemaphore:
+        console.banner("Extracting " + name + "...")
+        start = time.time()
+        with open(logFilename, 'w', encoding='utf-8') as log:
+            exitCode = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT)
+        seconds = time.time() - start
+    message = "Finished {} (exit code {}) in {:.1f}s, log: {}".format(name, exitCode, seconds, logFilename)
+    if exitCode == 0:
+        console.success(message)
+    else:
+        console.error(message)
+    result = {"device": name, "backupDir": os.path.abspath(backupDir), "outDir": os.path.abspath(outDir),
+              "exitCode": exitCode, "seconds": round(seconds, 3), "log": logFilename, "summary": None}
+    if os.path.isfile(summaryJson):
+        with open(summaryJson, 'r', encoding='utf-8') as file:
+            result["summary"] = json.load(file)
+    return result
+
+
+def batchMain(argv):
+    desc = "Extracts every backup of a Backup dir (one per device), each one to its own subdir of out_root\n" \
+            + "\nExample:  python3 iphoneMatic.py batch C:\\Users\\YourUser\\Apple\\MobileSync\\Backup F:\\Links" \
+            + "\nOther options are passed to each extraction, eg: --jobs 4 --link auto"
+    parser = argparse.ArgumentParser(prog="iphoneMatic.py batch", description=desc, formatter_class=RawTextHelpFormatter)
+    parser.add_argument('backup_root', help='Directory with one backup directory per device')
+    parser.add_argument('out_root', help='Destination directory, a subdirectory is created for each device')
+    parser.add_argument('--per-disk', type=int, default=1, help="Devices extracted at the same time from each disk (default: 1)")
+    args, extraArgs = parser.parse_known_args(argv)
+
+    backups = findBackups(args.backup_root)
+    if len(backups) == 0:
+        console.error("ERROR: No directories with a Manifest.db found in " + args.backup_root)
+        return 1
+    ensureDirs(args.out_root)
+
+    #Extractions are limited per physical disk (st_dev) of the backup, so they don't fight for bandwidth:
+    diskSemaphores = {}
+    for backupDir in backups:
+        dev = os.stat(backupDir).st_dev
+        if dev not in diskSemaphores:
+            diskSemaphores[dev] = threading.Semaphore(max(1, args.per_disk))
+    console.info("Found {} backups in {} disks".format(len(backups), len(diskSemaphores)))
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=len(backups)) as pool:
+        futures = [pool.submit(runBatchDevice, backupDir, args.out_root, extraArgs,
+                               diskSemaphores[os.stat(backupDir).st_dev]) for backupDir in backups]
+        results = [future.result() for future in futures]
+
+    failed = [result["device"] for result in results if result["exitCode"] != 0]
+    combined = {"started": datetime.fromtimestamp(start).isoformat(), "seconds": round(time.time() - start, 3),
+                "devices": results, "failed": failed}
+    summaryFilename = os.path.join(args.out_root, "batch_summary.json")
+    with open(summaryFilename, 'w', encoding='utf-8') as file:
+        json.dump(combined, file, indent=4)
+    console.summary("Extracted {} backups, {} failed. Summary: {}".format(len(results), len(failed), summaryFilename))
+    return 1 if len(failed) > 0 else 0
+
+
+VERIFY_CHUNK = 1024    #Files stat'ed by each task of the verify pool
+
+def statSizes(paths):
+    #Runs in the stat pool of verify. Returns the size of each file, None if it doesn't exist.
+    sizes = []
+    for path in paths:
+        try:
+            sizes.append(os.stat(path).st_size)
+        except OSError:
+            sizes.append(None)
+    return sizes
+
+def listShardDir(shardDir):
+    try:
+        with os.scandir(shardDir) as it:
+            return [entry.name for entry in it if entry.is_file()]
+    except OSError:
+        return []
+
+def countProblem(problemsByDomain, domain, problem):
+    counts = problemsByDomain.get(domain)
+    if counts == None:
+        counts = problemsByDomain[domain] = {"files": 0, "missing": 0, "truncated": 0, "larger": 0}
+    counts[problem] += 1
+
+def verifyBackup(backupDir, pool, databases, progress, cache=None):
+    #Compares the Size in Manifest.db of every file with the file in the backup. Returns
+    #({domain: counts}, extra fileIDs). Only the shard dirs are listed; files that are listed are
+    #stat'ed in parallel, in chunks, to find truncated ones. The sizes are read from the
+    #ManifestCache if there's one.
+    shardDirs = [os.path.join(backupDir, "{:02x}".format(n)) for n in range(256)]
+    listed = set()
+    for names in pool.map(listShardDir, shardDirs):
+        listed.update(names)
+
+    if cache != None:
+        total = sum(1 for flags in cache.columns["flags"] if flags == 1)
+        files = cache.files()
+    else:
+        conn = databases.connect(os.path.join(backupDir, 'Manifest.db'))
+        total = conn.execute("SELECT COUNT(*) FROM Files WHERE flags = 1").fetchone()[0]
+        files = ((fileID, domain, decodeFileSize(blob)) for fileID, domain, blob in conn.execute("SELECT fileID, domain, file FROM Files WHERE flags = 1"))
+    problemsByDomain = {}
+    inManifest = set()
+    futures = []
+    with progress.phase("Verify " + os.path.basename(os.path.normpath(backupDir)), total):
+        chunk = []
+        for fileID, domain, expectedSize in files:
+            inManifest.add(fileID)
+            countProblem(problemsByDomain, domain, "files")
+            if fileID not in listed:
+                countProblem(problemsByDomain, domain, "missing")
+                progress.advance()
+                continue
+            chunk.append((domain, expectedSize, os.path.join(backupDir, fileID[:2], fileID)))
+            if len(chunk) >= VERIFY_CHUNK:
+                futures.append((chunk, pool.submit(statSizes, [item[2] for item in chunk])))
+                chunk = []
+        futures.append((chunk, pool.submit(statSizes, [item[2] for item in chunk])))
+        for chunk, future in futures:
+            for (domain, expectedSize, _), size in zip(chunk, future.result()):
+                progress.advance()
+                if size == None:
+                    countProblem(problemsByDomain, domain, "missing")
+                elif expectedSize != None and size < expectedSize:
+                    countProblem(problemsByDomain, domain, "truncated")
+                elif expectedSize != None and size > expectedSize:
+                    countProblem(problemsByDomain, domain, "larger")
+    return problemsByDomain, sorted(listed - inManifest)
+
+def verifyOutDir(outDir, pool, databases, progress):
+    #Checks the files linked by previous runs, as recorded in the state journal of out_dir.
+    #Returns {category: counts}.
+    journalFilename = os.path.join(outDir, ExtractionJournal.FILENAME)
+    if not os.path.isfile(journalFilename):
+        console.warning("WARNING: " + journalFilename + " not found, out_dir can't be verified")
+        return {}
+    conn = databases.connect(journalFilename, ExtractionJournal.FILENAME)
+    rows = conn.execute("SELECT subdir, size, destFile FROM Links").fetchall()
+    problemsByCategory = {}
+    with progress.phase("Verify " + os.path.basename(os.path.normpath(outDir)), len(rows)):
+        chunks = [rows[k : k + VERIFY_CHUNK] for k in range(0, len(rows), VERIFY_CHUNK)]
+        for chunk, sizes in zip(chunks, pool.map(statSizes, [[row[2] for row in chunk] for chunk in chunks])):
+            for (category, expectedSize, _), size in zip(chunk, sizes):
+                progress.advance()
+                countProblem(problemsByCategory, category, "files")
+                if size == None:
+                    countProblem(problemsByCategory, category, "missing")
+                elif expectedSize != None and size < expectedSize:
+                    countProblem(problemsByCategory, category, "truncated")
+                elif expectedSize != None and size > expectedSize:
+                    countProblem(problemsByCategory, category, "larger")
+    return problemsByCategory
+
+def printProblems(title, problemsByKey):
+    #Prints the domains (or categories) with problems. Returns True if there are none.
+    problems = {key: counts["missing"] + counts["truncated"] + counts["larger"] for key, counts in problemsByKey.items()}
+    files = sum(counts["files"] for counts in problemsByKey.values())
+    message = "{}: {} files, {} with problems".format(title, files, sum(problems.values()))
+    if sum(problems.values()) == 0:
+        console.success(message)
+    else:
+        console.error(message)
+    for key in sorted(key for key in problems if problems[key] > 0):
+        counts = problemsByKey[key]
+        console.summary("    {}: {} missing, {} truncated, {} larger than expected (of {} files)".format(
+              key, counts["missing"], counts["truncated"], counts["larger"], counts["files"]))
+    return sum(problems.values()) == 0
+
+def verifyMain(argv):
+    desc = "Checks that a backup is complete before extracting it: every file of Manifest.db must be in the\n" \
+            + "backup with the size recorded in Manifest.db. Optionally checks the files already extracted to out_dir.\n" \
+            + "\nExample:  python3 iphoneMatic.py verify F:\\Backup\\00008110-001A18D40EFB801E F:\\Links"
+    parser = argparse.ArgumentParser(prog="iphoneMatic.py verify", description=desc, formatter_class=RawTextHelpFormatter)
+    parser.add_argument('backup_dir', help='Location of backup directory')
+    parser.add_argument('out_dir', nargs='?', help='Destination directory of previous extractions, to check too')
+    parser.add_argument('-j', '--jobs', type=int, default=16, help="Number of threads doing the stat calls (default: 16)")
+    parser.add_argument('--summary-json', metavar='FILE', help="Write the problems found as JSON")
+    args = parser.parse_args(argv)
+
+    if not os.path.isfile(os.path.join(args.backup_dir, 'Manifest.db')):
+        console.error("ERROR: Manifest.db not found in " + args.backup_dir)
+        return 1
+    progress = Progress()
+    databases = SourceDatabases()
+    cache = None
+    if args.out_dir != None:
+        #The manifest cache of previous extractions has the sizes already decoded:
+        cache = ManifestCache(args.out_dir)
+        if not cache.load(ManifestCache.signature(os.path.join(args.backup_dir, 'Manifest.db'))):
+            cache = None
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        problemsByDomain, extraFiles = verifyBackup(args.backup_dir, pool, databases, progress, cache)
+        problemsByCategory = {}
+        if args.out_dir != None:
+            problemsByCategory = verifyOutDir(args.out_dir, pool, databases, progress)
+    databases.close()
+    if cache != None:
+        cache.close()
+
+    progress.printSummary()
+    ok = printProblems("Backup", problemsByDomain)
+    if len(extraFiles) > 0:
+        ok = False
+        console.error("Extra files not in Manifest.db: {}".format(len(extraFiles)))
+        for fileID in extraFiles[:10]:
+            console.summary("    " + fileID)
+    if args.out_dir != None:
+        ok = printProblems("Extracted files", problemsByCategory) and ok
+    if args.summary_json != None:
+        progress.writeJson(args.summary_json, {"backupDir": os.path.abspath(args.backup_dir),
+                                               "problemsByDomain": problemsByDomain, "extraFiles": extraFiles,
+                                               "outDir": os.path.abspath(args.out_dir) if args.out_dir != None else None,
+                                               "problemsByCategory": problemsByCategory})
+    return 0 if ok else 1
+
+def lookupMain(argv):
+    desc = "Finds in the index of an extraction where its files came from, or where the files of the backup\n" \
+            + "were extracted to. TERMS are names or paths in out_dir, or fileIDs. With --source they are\n" \
+            + "relative paths in the backup. Terms with * ? or [ are globs\n" \
+            + "\nExamples:  python3 iphoneMatic.py lookup F:\\Links IMG_20250711_220111.PNG" \
+            + "\n           python3 iphoneMatic.py lookup F:\\Links 'Camera/2025*/*.MOV'" \
+            + "\n           python3 iphoneMatic.py lookup --source F:\\Links Media/DCIM/100APPLE/IMG_0001.PNG"
+    parser = argparse.ArgumentParser(prog="iphoneMatic.py lookup", description=desc, formatter_class=RawTextHelpFormatter)
+    parser.add_argument('index', help="Destination directory of an extraction, or the .index.sqlite of an --archive")
+    parser.add_argument('terms', nargs='+', metavar='TERMS', help="Names, paths or fileIDs to look up")
+    parser.add_argument('-s', '--source', action='store_true', help="Terms are relative paths in the backup (Manifest.db)")
+    parser.add_argument('--json', action='store_true', help="Print every file found as a JSON line")
+    args = parser.parse_args(argv)
+
+    filename = args.index
+    if os.path.isdir(filename):
+        filename = os.path.join(filename, ExportIndex.FILENAME)
+    if not os.path.isfile(filename):
+        console.error("ERROR: No export index found at " + filename)
+        return 1
+    conn = sqlite3.connect(pathlib.Path(os.path.abspath(filename)).as_uri() + "?mode=ro", uri=True)
+    found = 0
+    for term in args.terms:
+        rows = lookupExports(conn, term, args.source)
+        if len(rows) == 0:
+            console.warning("Not found: " + term)
+        for dest, fileID, domain, relativePath, size, mtime, category in rows:
+            found += 1
+            if args.json:
+                console.summary(json.dumps({"dest": dest, "fileID": fileID, "domain": domain, "relativePath": relativePath,
+                                            "size": size, "mtime": mtime, "category": category}))
+                continue
+            dateStr = datetime.fromtimestamp(mtime).strftime("%Y-%m-%d %H:%M:%S") if mtime != None else "?"
+            console.summary("{} <- {} {} ({}/{}, {} bytes, {})".format(dest, domain, relativePath, fileID[:2], fileID, size, dateStr))
+    conn.close()
+    return 0 if found > 0 else 1
+
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        sys.exit(batchMain(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "verify":
+        sys.exit(verifyMain(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "lookup":
+        sys.exit(lookupMain(sys.argv[2:]))
+
     desc = "Extracts images as hardlinks and sets the correct date - by JMC\n" \
             + "\nExample:  python3 iphoneMatic.py F:\\Backup\\00008110-001A18D40EFB801E F:\\DCIM" \
-            + "\nNote: output datetimes are in local timezone"
+            + "\nNote: output datetimes are in local timezone" \
+            + "\n\nTo extract all the devices of a Backup dir:  python3 iphoneMatic.py batch --help" \
+            + "\nTo check that a backup is complete:  python3 iphoneMatic.py verify --help" \
+            + "\nTo find where an extracted file came from:  python3 iphoneMatic.py lookup --help"
 
     parser = argparse.ArgumentParser(description=desc, formatter_class=RawTextHelpFormatter)
 
@@ -778,31 +3129,99 @@ def main():
     parser.add_argument('-n', '--pretend', action='store_true', help="Print source and dest but don't create hardlinks")
     parser.add_argument('-u', '--numeric', action='store_true', help="Use IMG_NNNN.JPG instead of IMG_YYYYmmdd_HHMMSS.JPG")
     parser.add_argument('-i', '--ignore-albums', action='store_true', help="Don't create subfolders for albums")
+    parser.add_argument('-j', '--jobs', type=int, help="Number of threads creating the links (default: 1, or 4 when copying)")
+    parser.add_argument('--link', choices=LINK_STRATEGIES, default="hardlink",
+                        help="How to create the files: hardlink (default), reflink (btrfs, XFS), copy,\n" \
+                        + "or auto to use the cheapest one that works between backup_dir and out_dir")
+    parser.add_argument('-p', '--procs', type=int, default=1, help="Number of processes decoding the Manifest.db metadata (default: 1)")
+    parser.add_argument('--no-fs-cache', action='store_true', help="Stat every file instead of listing the directories once")
+    planGroup = parser.add_mutually_exclusive_group()
+    planGroup.add_argument('--plan', metavar='FILE', help="Write the links that would be created to a .jsonl plan, without creating them")
+    planGroup.add_argument('--apply', metavar='FILE', help="Create the links of a plan written with --plan, without reading Manifest.db")
+    parser.add_argument('--archive', metavar='FILE', help="Write the files, chats, contacts and notes into a single .tar, .tar.gz or .zip\n" \
+                        + "instead of linking them in out_dir (for drives without hardlinks). .tar.gz is\n" \
+                        + "compressed by --jobs threads (default: 4)")
+    parser.add_argument('--summary-json', metavar='FILE', help="Write counts, throughput and errors of every phase as JSON")
+    parser.add_argument('--dedup-index', metavar='FILE', help="Content index shared by the extractions of several snapshots. Files already\n" \
+                        + "extracted from an older snapshot are hardlinked from there instead of from this backup")
+    parser.add_argument('--full', action='store_true', help="Ignore the state of previous runs and process every file again")
+    parser.add_argument('--no-manifest-cache', action='store_true', help="Read Manifest.db instead of the decoded copy kept in out_dir")
+    parser.add_argument('--probe-dates', action='store_true', help="Name the photos and videos of app files (FTPManager, Files, FilesAppGroups)\n" \
+                        + "IMG_/VID_YYYYmmdd_HHMMSS by the date inside them (EXIF, QuickTime), reading only their headers")
+    parser.add_argument('--multi-scan', action='store_true', help="Query Manifest.db once per category instead of a single scan (slower)")
+    categoryGroup = parser.add_mutually_exclusive_group()
+    categoryGroup.add_argument('--only', metavar='CATEGORIES', type=parseCategories,
+                               help="Comma separated categories to extract, the others are skipped:\n" + ", ".join(CATEGORIES))
+    categoryGroup.add_argument('--skip', metavar='CATEGORIES', type=parseCategories, help="Comma separated categories not to extract")
+    parser.add_argument('--since', metavar='DATE', type=parseSince,
+                        help="Only extract files, chats and notes modified since DATE (YYYY-MM-DD). Names stay\n" \
+                             + "the same as in a full run")
+    verbosityGroup = parser.add_mutually_exclusive_group()
+    verbosityGroup.add_argument('-q', '--quiet', action='store_true', help="Only show errors and the final summary")
+    verbosityGroup.add_argument('-v', '--verbose', action='store_true', help="Show a line for every file linked or written")
+    parser.add_argument('--log-jsonl', metavar='FILE', help="Write every file linked, error and phase as a JSON line")
+    parser.add_argument('--profile', metavar='DIR', help="Profile the CPU and memory of every stage. Writes a .pstats file per stage\n" \
+                        + "and report.txt with the time spent in bplist, SQLite, filesystem and HTML code")
 
     args = parser.parse_args()
-
-
-    matic = IPhoneMatic(args.backup_dir, args.out_dir, args.pretend, args.numeric, args.ignore_albums)
-    print(BLUE_COLOR + "Extracting links to camera pictures..." + NO_COLOR)
-    matic.extractHardlinks("Camera", "CameraRollDomain", "%Media/DCIM%", "TypePhotos")
-    matic.extractHardlinks("FTPManager", "AppDomainGroup-group.com.skyjos.ftpmanager", "%", "TypeApp")
-    matic.extractHardlinks("Files", "AppDomainGroup-group.com.apple.FileProvider.LocalStorage", "%", "TypeApp")
-    matic.extractHardlinks("FilesHome", "HomeDomain", "%", "TypeApp")
-    matic.extractHardlinks("FilesAppGroups", "AppDomainGroup-%", "%", "TypeAppGroup")
-    #Some Thumbnails:
-    #    matic.extractHardlinks("FromMac", "CameraRollDomain", "%Media/PhotoData/Thumbnails/V2/PhotoData/Sync/100SYNCD/%")
-    #More Thumbnails:
-    #    matic.extractHardlinks("Thumbnails", "CameraRollDomain", "%Media/PhotoData/Metadata/PhotoData/Sync/100SYNCD/%")
-    print(BLUE_COLOR + "Extracting links to whatsapp pictures..." + NO_COLOR)
-    matic.extractHardlinks("WhatsappProfilePictures", "AppDomainGroup-group.net.whatsapp.WhatsApp.shared", "%Media/Profile/%jpg")
-    matic.extractHardlinksWhatsapp("Whatsapp", "WhatsappThumbnails", "WhatsappStickers", "AppDomainGroup-group.net.whatsapp.WhatsApp.shared", "%Message/Media%")
-    print(BLUE_COLOR + "Extracting links to app files..." + NO_COLOR)
-    #Export notes:
-    matic.exportNotes()
-    #Export contacts
-    matic.exportContacts()
-    #Export Whatsapp chats
-    matic.exportWhatsappChats()
+    if args.archive != None and args.plan != None:
+        parser.error("--archive can't be used with --plan, use it with --apply")
+    if args.archive != None and archiveFormat(args.archive) == None:
+        parser.error("--archive must end in .tar, .tar.gz, .tgz or .zip")
+
+    level = Console.QUIET if args.quiet else Console.VERBOSE if args.verbose else Console.NORMAL
+    #With --pretend the lines of the files are the output:
+    console.configure(level, showFiles=args.pretend, eventLogFilename=args.log_jsonl)
+
+    linkStrategy = args.link
+    if linkStrategy == "auto":
+        linkStrategy = "hardlink"
+        if not args.pretend and args.plan == None and args.archive == None:
+            linkStrategy = probeLinkStrategy(args.backup_dir, args.out_dir)
+        console.info("Link strategy: " + linkStrategy)
+    jobs = args.jobs
+    if jobs == None:
+        #Copies and compression are slow, do them in parallel:
+        jobs = 1 if linkStrategy == "hardlink" and args.archive == None else 4
+
+    categories = CATEGORIES
+    if args.only != None:
+        categories = args.only
+    if args.skip != None:
+        categories = [category for category in CATEGORIES if category not in args.skip]
+    rules = [rule for rule in EXTRACT_RULES if rule.subdir in categories]
+
+    matic = IPhoneMatic(args.backup_dir, args.out_dir, args.pretend, args.numeric, args.ignore_albums, max(1, jobs), args.full, max(1, args.procs), not args.no_fs_cache, args.plan,
+                        linkStrategy, args.dedup_index, args.since, args.profile, not args.no_manifest_cache, args.probe_dates,
+                        args.archive)
+    #Closed even if the run fails, so the journal, the indexes and the archive are complete up to there:
+    try:
+        if args.apply != None:
+            matic.applyPlan(args.apply, categories)
+        elif args.multi_scan:
+            for rule in rules:
+                matic.extractRule(rule)
+        else:
+            matic.extractRules(rules)
+        if args.plan != None:
+            #Notes, contacts and chats are exported when the plan is applied:
+            matic.close()
+            matic.reportStats(args.summary_json)
+            return
+        console.banner("Extracting links to app files...")
+        #Export notes:
+        if "Notes" in categories:
+            matic.exportNotes()
+        #Export contacts
+        if "Contacts" in categories:
+            matic.exportContacts()
+        #Export Whatsapp chats
+        if "WhatsappChats" in categories:
+            matic.exportWhatsappChats()
+        matic.reportStats(args.summary_json)
+    finally:
+        matic.close()
+        console.close()
 
 
 
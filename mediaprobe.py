@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# mediaprobe - part of iphoneMatic
+#
+# Reads the date a photo or video was taken from the metadata inside the file: EXIF DateTimeOriginal
+# of JPEG and HEIC files, and the creation time of the mvhd box of MOV and MP4 files. Only the
+# headers are read, seeking over everything else, so a probe reads a few KB however big the file is.
+#
+#     python3 mediaprobe.py IMG_1234.JPG clip.mov
+#
+# License:   <a href="http://www.boost.org/LICENSE_1_0.txt">Boost License 1.0</a>.
+# Source:    mediaprobe.py
+#
+#          Copyright Juan Manuel Cabo 2026.
+# Distributed under the Boost Software License, Version 1.0.
+#    (See accompanying file LICENSE_1_0.txt or copy at
+#          http://www.boost.org/LICENSE_1_0.txt)
+#
+
+import os
+import sys
+import struct
+import time
+from datetime import datetime
+
+PROBE_EXTENSIONS = {".jpg", ".jpeg", ".heic", ".heif", ".mov", ".mp4", ".m4v", ".3gp"}   #Names of the files worth probing
+HEIF_BRANDS = {b"heic", b"heix", b"heim", b"heis", b"mif1", b"msf1", b"avif"}
+MAX_SEGMENT = 128 * 1024      #Most bytes read from a JPEG segment, HEIF meta box or Exif item
+MAX_BOXES = 64                #Boxes looked at in each level of a HEIF/QuickTime file
+QUICKTIME_EPOCH = 2082844800  #Seconds from 1904-01-01 to 1970-01-01
+MIN_DATE = 315532800          #1980-01-01, earlier dates are unset clocks
+
+#EXIF tags, by order of preference:
+TAG_EXIF_IFD = 0x8769
+TAG_DATETIME_ORIGINAL = 0x9003
+TAG_DATETIME_DIGITIZED = 0x9004
+TAG_DATETIME = 0x0132
+
+
+def probeDate(filename):
+    #Returns the date (unix time) the photo or video was taken, or None if it's not a known
+    #format, has no date, or can't be read. The format is told by the first bytes, files in
+    #the backup have no extension.
+    try:
+        with open(filename, 'rb', buffering=0) as file:
+            magic = file.read(12)
+            file.seek(0)
+            if magic[:2] == b"\xFF\xD8":
+                date = probeJpeg(file)
+            elif magic[4:8] == b"ftyp" and magic[8:12] in HEIF_BRANDS:
+                date = probeHeif(file)
+            elif magic[4:8] in (b"ftyp", b"moov", b"mdat", b"wide", b"free", b"skip"):
+                date = probeQuicktime(file)
+            else:
+                return None
+    except (OSError, ValueError, struct.error, IndexError):
+        return None
+    if date == None or date < MIN_DATE or date > time.time() + 86400:
+        return None
+    return date
+
+def readExactly(file, length):
+    data = file.read(length)
+    if len(data) != length:
+        raise ValueError("Truncated file")
+    return data
+
+
+def probeJpeg(file):
+    #Walks the segments until APP1 "Exif", skipping the others with a seek:
+    if readExactly(file, 2) != b"\xFF\xD8":
+        return None
+    while True:
+        marker, length = struct.unpack(">HH", readExactly(file, 4))
+        if marker & 0xFF00 != 0xFF00 or marker == 0xFFDA or length < 2:   #Start of scan: no more metadata
+            return None
+        skip = length - 2
+        if marker == 0xFFE1:
+            segment = file.read(min(skip, MAX_SEGMENT))
+            if segment.startswith(b"Exif\0\0"):
+                return exifDate(segment[6:])
+            skip -= len(segment)
+        file.seek(skip, os.SEEK_CUR)
+
+
+def exifDate(tiff):
+    #tiff is the TIFF structure of the EXIF data (starting at "II" or "MM"):
+    if tiff[:2] == b"II":
+        endian = "<"
+    elif tiff[:2] == b"MM":
+        endian = ">"
+    else:
+        return None
+
+    def ifdEntries(offset):
+        count = struct.unpack_from(endian + "H", tiff, offset)[0]
+        entries = {}
+        for i in range(count):
+            tag, valueType, valueCount, value = struct.unpack_from(endian + "HHI4s", tiff, offset + 2 + i * 12)
+            entries[tag] = (valueType, valueCount, value)
+        return entries
+
+    def asciiValue(entry):
+        valueType, valueCount, value = entry
+        if valueType != 2:
+            return None
+        if valueCount > 4:
+            start = struct.unpack(endian + "I", value)[0]
+            value = tiff[start:start + valueCount]
+        return value.split(b"\0")[0].decode("ascii", "replace")
+
+    ifd0 = ifdEntries(struct.unpack_from(endian + "I", tiff, 4)[0])
+    candidates = []
+    if TAG_EXIF_IFD in ifd0:
+        exifIfd = ifdEntries(struct.unpack(endian + "I", ifd0[TAG_EXIF_IFD][2])[0])
+        candidates = [exifIfd.get(TAG_DATETIME_ORIGINAL), exifIfd.get(TAG_DATETIME_DIGITIZED)]
+    candidates.append(ifd0.get(TAG_DATETIME))
+    for entry in candidates:
+        if entry == None:
+            continue
+        value = asciiValue(entry)
+        try:
+            #EXIF dates are local time, like the names made from them:
+            return datetime.strptime(value.strip(), "%Y:%m:%d %H:%M:%S").timestamp()
+        except (ValueError, AttributeError):
+            continue
+    return None
+
+
+def boxes(file, start, end):
+    #Yields (type, payload start, payload end) of the ISO BMFF boxes between start and end,
+    #reading only their headers.
+    offset = start
+    for i in range(MAX_BOXES):
+        if end != None and offset + 8 > end:
+            return
+        file.seek(offset)
+        header = file.read(8)
+        if len(header) < 8:
+            return
+        size, boxType = struct.unpack(">I4s", header)
+        payload = offset + 8
+        if size == 1:
+            size = struct.unpack(">Q", readExactly(file, 8))[0]
+            payload += 8
+        elif size == 0:    #Up to the end of the file
+            size = os.fstat(file.fileno()).st_size - offset
+        if size < payload - offset:
+            return
+        yield boxType, payload, offset + size
+        offset += size
+
+
+def probeQuicktime(file):
+    #The creation time of moov/mvhd, which is in UTC:
+    for boxType, start, end in boxes(file, 0, None):
+        if boxType != b"moov":
+            continue
+        for childType, childStart, childEnd in boxes(file, start, end):
+            if childType == b"mvhd":
+                file.seek(childStart)
+                header = readExactly(file, 12)
+                if header[0] == 1:
+                    created = struct.unpack(">Q", header[4:12])[0]
+                else:
+                    created = struct.unpack(">I", header[4:8])[0]
+                return created - QUICKTIME_EPOCH if created != 0 else None
+        return None
+    return None
+
+
+def probeHeif(file):
+    #The Exif item of the meta box: its id is in iinf, its position in the file in iloc.
+    for boxType, start, end in boxes(file, 0, None):
+        if boxType != b"meta":
+            continue
+        if end - start > MAX_SEGMENT:
+            return None
+        file.seek(start)
+        meta = readExactly(file, end - start)
+        exifItem = None
+        location = None
+        offset = 4    #meta is a full box: version and flags
+        while offset + 8 <= len(meta):
+            size, childType = struct.unpack_from(">I4s", meta, offset)
+            if size < 8:
+                return None
+            if childType == b"iinf":
+                exifItem = heifExifItemId(meta[offset + 8:offset + size])
+            elif childType == b"iloc":
+                location = meta[offset + 8:offset + size]
+            offset += size
+        if exifItem == None or location == None:
+            return None
+        extent = heifItemExtent(location, exifItem)
+        if extent == None:
+            return None
+        file.seek(extent[0])
+        exif = file.read(min(extent[1], MAX_SEGMENT))
+        #The item starts with the offset of the TIFF header after the 4 bytes of the offset itself:
+        tiffStart = 4 + struct.unpack(">I", exif[:4])[0]
+        return exifDate(exif[tiffStart:])
+    return None
+
+def heifExifItemId(iinf):
+    version = iinf[0]
+    count = struct.unpack(">H", iinf[4:6])[0] if version == 0 else struct.unpack(">I", iinf[4:8])[0]
+    offset = 6 if version == 0 else 8
+    for i in range(count):
+        size, entryType = struct.unpack_from(">I4s", iinf, offset)
+        if entryType == b"infe" and iinf[offset + 8] >= 2:
+            entryVersion = iinf[offset + 8]
+            if entryVersion == 2:
+                itemId = struct.unpack_from(">H", iinf, offset + 12)[0]
+                itemType = iinf[offset + 16:offset + 20]
+            else:
+                itemId = struct.unpack_from(">I", iinf, offset + 12)[0]
+                itemType = iinf[offset + 18:offset + 22]
+            if itemType == b"Exif":
+                return itemId
+        if size < 8:
+            return None
+        offset += size
+    return None
+
+def heifItemExtent(iloc, itemId):
+    #Returns (file offset, length) of the first extent of the item:
+    version = iloc[0]
+    offsetSize = iloc[4] >> 4
+    lengthSize = iloc[4] & 0x0F
+    baseOffsetSize = iloc[5] >> 4
+    indexSize = iloc[5] & 0x0F if version in (1, 2) else 0
+    offset = 6
+    if version < 2:
+        count = struct.unpack_from(">H", iloc, offset)[0]
+        offset += 2
+    else:
+        count = struct.unpack_from(">I", iloc, offset)[0]
+        offset += 4
+
+    def readInt(size):
+        nonlocal offset
+        value = int.from_bytes(iloc[offset:offset + size], "big") if size > 0 else 0
+        offset += size
+        return value
+
+    for i in range(count):
+        currentId = readInt(2 if version < 2 else 4)
+        constructionMethod = readInt(2) & 0x0F if version in (1, 2) else 0
+        readInt(2)    #Data reference index
+        baseOffset = readInt(baseOffsetSize)
+        extentCount = readInt(2)
+        extents = []
+        for j in range(extentCount):
+            readInt(indexSize)
+            extents.append((baseOffset + readInt(offsetSize), readInt(lengthSize)))
+        if currentId == itemId:
+            if constructionMethod != 0 or len(extents) == 0:
+                return None    #Only items stored in the file are supported
+            return extents[0]
+    return None
+
+
+#Run program:
+if __name__ == "__main__":
+    for filename in sys.argv[1:]:
+        date = probeDate(filename)
+        print("{}: {}".format(filename, datetime.fromtimestamp(date).strftime("%Y-%m-%d %H:%M:%S") if date != None else "no date"))
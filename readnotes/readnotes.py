@@ -31,6 +31,9 @@ from biplist import *
 
 from notes2html import ReadAttachments, ProcessNoteBodyBlob, DefaultCss, PrintAttachments
 
+# Set by --quiet: don't print a line for every note (errors and warnings are still printed)
+QUIET = False
+
 '''
    Copyright (c) 2017 Yogesh Khatri 
 
@@ -197,7 +200,14 @@ def ExecuteQuery(db, query):
     error = str(ex)
   return None, error
 
-def ReadNotesHighSierra(db, source, user, css, attachments, odb, blob_path, outputPath=""):
+def SinceClause(since):
+  '''WHERE clause selecting notes modified since a unix timestamp (None for all)'''
+  if since is None:
+    return ""
+  # Notes dates are Mac absolute times, seconds since 2001-01-01
+  return " WHERE c1.ZMODIFICATIONDATE1 >= {} ".format(float(since) - 978307200)
+
+def ReadNotesHighSierra(db, source, user, css, attachments, odb, blob_path, outputPath="", since=None):
   '''Read Notestore.sqlite'''
   try:
     query = " SELECT n.Z_PK, n.ZNOTE as note_id, n.ZDATA as data, " \
@@ -213,6 +223,7 @@ def ReadNotesHighSierra(db, source, user, css, attachments, odb, blob_path, outp
             " LEFT JOIN ZICCLOUDSYNCINGOBJECT as c3 ON c3.ZNOTE= n.ZNOTE "\
             " LEFT JOIN ZICCLOUDSYNCINGOBJECT as c4 ON c4.ZATTACHMENT1= c3.Z_PK "\
             " LEFT JOIN ZICCLOUDSYNCINGOBJECT as c5 ON c5.Z_PK = c1.ZACCOUNT2  "\
+            + SinceClause(since) + \
             " ORDER BY note_id  "
     db.row_factory = sqlite3.Row
     cursor = db.execute(query)
@@ -263,6 +274,14 @@ def ReadNotesHighSierra(db, source, user, css, attachments, odb, blob_path, outp
   except sqlite3.Error:
     _log_error('Query  execution failed. Query was: ' + query)
 
+def IsNoteStoreDb(db):
+  '''True if db has the NoteStore tables, for files not named NoteStore.sqlite (eg: in a backup)'''
+  try:
+    cursor = db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name = 'ZICCLOUDSYNCINGOBJECT'")
+    return cursor.fetchone() is not None
+  except sqlite3.Error:
+    return False
+
 def IsHighSierraDb(db):
   '''Returns false if Z_xxNOTE is a table where xx is a number'''
   try:
@@ -290,7 +309,8 @@ def fixFilename(s):         #debug
     return s
 
 def writeToFile(filename, content):
-    print("Writing to", filename) #debug
+    if not QUIET:
+        print("Writing to", filename) #debug
     try:
         with open(filename, 'w', encoding='utf-8') as file:
             file.write(content)
@@ -331,13 +351,13 @@ def ReadQueryResults(cursor, user, source, css, attachments, odb):
     except sqlite3.Error:
       _log_error('Error fetching row data')
 
-def ReadNotes(db, source, user, css, odb, blob_path, outputPath):
+def ReadNotes(db, source, user, css, odb, blob_path, outputPath, since=None):
   '''Read Notestore.sqlite'''
   attachments = {}
   ReadAttachments(db, attachments, source, user)
 
   if IsHighSierraDb(db):
-    ReadNotesHighSierra(db, source, user, css, attachments, odb, blob_path, outputPath)
+    ReadNotesHighSierra(db, source, user, css, attachments, odb, blob_path, outputPath, since)
     return
 
   query1 = " SELECT n.Z_12FOLDERS as folder_id , n.Z_9NOTES as note_id, d.ZDATA as data, " \
@@ -353,6 +373,7 @@ def ReadNotes(db, source, user, css, odb, blob_path, outputPath):
           " LEFT JOIN ZICCLOUDSYNCINGOBJECT as c3 ON c3.ZNOTE = n.Z_9NOTES " \
           " LEFT JOIN ZICCLOUDSYNCINGOBJECT as c4 ON c3.ZMEDIA = c4.Z_PK " \
           " LEFT JOIN ZICCLOUDSYNCINGOBJECT as c5 ON c5.Z_PK = c1.ZACCOUNT2 " \
+          + SinceClause(since) + \
           " ORDER BY note_id "
   query2 = " SELECT n.Z_11FOLDERS as folder_id , n.Z_8NOTES as note_id, d.ZDATA as data, " \
           " c2.ZTITLE2 as folder, c2.ZDATEFORLASTTITLEMODIFICATION as folder_title_modified, " \
@@ -367,6 +388,7 @@ def ReadNotes(db, source, user, css, odb, blob_path, outputPath):
           " LEFT JOIN ZICCLOUDSYNCINGOBJECT as c3 ON c3.ZNOTE = n.Z_8NOTES " \
           " LEFT JOIN ZICCLOUDSYNCINGOBJECT as c4 ON c3.ZMEDIA = c4.Z_PK " \
           " LEFT JOIN ZICCLOUDSYNCINGOBJECT as c5 ON c5.Z_PK = c1.ZACCOUNT2 " \
+          + SinceClause(since) + \
           " ORDER BY note_id "
   cursor, error1 = ExecuteQuery(db, query1)
   if cursor:
@@ -414,7 +436,6 @@ def ReadNotesV2_V4_V6(db, version, source, user, odb):
         columns["apple_version"] = 'NoteStore'
         columns["apple_user"] = user
         columns["apple_source"] = source
-        print("a")
         process_note(columns, odb)
       except (sqlite3.Error, KeyError):
         _log_error('Error fetching row data')
@@ -446,6 +467,12 @@ def _get_option_parser():
     parser.add_option("--blob",
                       action="store_true", dest="output_blob", default=False,
                       help="Write BLOBs to 'blob' directory in output directory")
+    parser.add_option("--since",
+                      action="store", dest="since", type="float", default=None,
+                      help="Only export notes modified since this unix timestamp")
+    parser.add_option("--quiet",
+                      action="store_true", dest="quiet", default=False,
+                      help="Don't print a line for every note written")
     return parser
 
 def process_note(columns, sqlconn):
@@ -465,6 +492,9 @@ def main(args):
   parser = _get_option_parser()
   (options, args) = parser.parse_args(args)
 
+  global QUIET
+  QUIET = options.quiet
+
   userName = ''
 
   if hasattr(options, 'user_name') and options.user_name:
@@ -519,7 +549,8 @@ def main(args):
 
   new_database = (not os.path.isfile(notesdbfile))
 
-  print("input database '%s'" % (macosdbfile,))
+  if not QUIET:
+    print("input database '%s'" % (macosdbfile,))
 
   macos_sqlconn = sqlite3.connect(macosdbfile) #,
   #  detect_types=sqlite3.PARSE_DECLTYPES)
@@ -548,8 +579,8 @@ def main(args):
         ReadNotesV2_V4_V6(macos_sqlconn, 'V6', macosdbfile, userName, sqlconn)
     elif filename.find('V7') > 0:
         ReadNotesV2_V4_V6(macos_sqlconn, 'V7', macosdbfile, userName, sqlconn)
-    elif filename.find('NoteStore') >= 0:
-        ReadNotes(macos_sqlconn, macosdbfile, userName, css, sqlconn, blobPath, outputPath)
+    elif filename.find('NoteStore') >= 0 or IsNoteStoreDb(macos_sqlconn):
+        ReadNotes(macos_sqlconn, macosdbfile, userName, css, sqlconn, blobPath, outputPath, options.since)
     else:
         _log_error('Unknown database type, not a recognized file name')
     sqlconn.commit()